@@ -30,12 +30,14 @@ import functools
 from typing import List
 
 import torch
+import torch.distributed
 from cuda import cuda, cudart
 
 import triton
 import triton.language as tl
 from triton_dist import pynvshmem
 from triton_dist.kernels.nvidia.common_ops import set_signal, wait_eq
+from triton_dist.kernels.nvidia.low_latency_allgather import broadcast_naive_block
 from triton_dist.utils import CUDA_CHECK, get_numa_world_size, get_has_nvlink
 from triton.language.extra import libshmem_device
 from triton.language.extra.cuda.language_extra import __syncthreads, tid
@@ -49,6 +51,8 @@ class AllGatherMethod(Enum):
     Ring2D_IntraNode = 4
     Ring1D_InterNode = 5
     Ring2D_InterNode = 6
+    NVLS_IntraNode = 7
+    NCCL_InterNode = 8
 
 
 @functools.lru_cache()
@@ -91,14 +95,8 @@ def cp_engine_producer_all_gather_full_mesh_push(
         for dst_rank in push_order:
             dst = remote_tensor_buffers[dst_rank][rank * M_per_rank:(rank + 1) * M_per_rank, :]
             dst.copy_(src)
-
-            (err, ) = cuda.cuStreamWriteValue32(
-                stream.cuda_stream,
-                barrier_buffers[dst_rank][rank].data_ptr(),
-                1,
-                cuda.CUstreamWriteValue_flags.CU_STREAM_WRITE_VALUE_DEFAULT,
-            )
-            CUDA_CHECK(err)
+            set_signal(barrier_buffers[dst_rank][rank].data_ptr(), 1, stream,
+                       require_i64=barrier_buffers[dst_rank].dtype == torch.uint64)
 
 
 def cp_engine_producer_all_gather_full_mesh_pull(
@@ -109,7 +107,13 @@ def cp_engine_producer_all_gather_full_mesh_pull(
     barrier_buffers: List[torch.Tensor],
     stream: torch.cuda.Stream,
     for_correctness=False,
+    scale_buffers: List[torch.Tensor] = None,
+    src_ready_buffer: torch.Tensor = None,
 ):
+    """ if scale_buffers is given, the per-row scales are gathered together with the rows of remote_tensor_buffers.
+        if src_ready_buffer is given, the slot of each source rank is pulled only once src_ready_buffer[src_rank]
+        is raised by that rank, and the flag is re-armed for the next round.
+    """
     M_per_rank, N = local_tensor.shape
 
     rank_orders = [(rank + i) % num_ranks for i in range(num_ranks)]
@@ -122,17 +126,17 @@ def cp_engine_producer_all_gather_full_mesh_pull(
         for src_rank in rank_orders:
             if src_rank == rank:
                 continue
+            if src_ready_buffer is not None:
+                wait_eq(src_ready_buffer[src_rank].data_ptr(), 1, stream)
+                set_signal(src_ready_buffer[src_rank].data_ptr(), 0, stream)
             dst = remote_tensor_buffers[rank][src_rank * M_per_rank:(src_rank + 1) * M_per_rank, :]
             src = remote_tensor_buffers[src_rank][src_rank * M_per_rank:(src_rank + 1) * M_per_rank, :]
             dst.copy_(src)
-
-            (err, ) = cuda.cuStreamWriteValue32(
-                stream.cuda_stream,
-                barrier_buffers[rank][src_rank].data_ptr(),
-                1,
-                cuda.CUstreamWriteValue_flags.CU_STREAM_WRITE_VALUE_DEFAULT,
-            )
-            CUDA_CHECK(err)
+            if scale_buffers is not None:
+                dst_scale = scale_buffers[rank][src_rank * M_per_rank:(src_rank + 1) * M_per_rank]
+                dst_scale.copy_(scale_buffers[src_rank][src_rank * M_per_rank:(src_rank + 1) * M_per_rank])
+            set_signal(barrier_buffers[rank][src_rank].data_ptr(), 1, stream,
+                       require_i64=barrier_buffers[rank].dtype == torch.uint64)
 
 
 def cp_engine_producer_all_gather_ring_push_1d(
@@ -258,6 +262,50 @@ def cp_engine_producer_all_gather_ring_push_numa_2d(
             set_ready(to_rank, send_segment, stream)
 
 
+@triton.jit
+def nvls_broadcast_kernel(dst_ptr, src_ptr, nbytes):
+    """ broadcast src to dst of all ranks in the node with multimem.st. dst_ptr should be a symmetric pointer. """
+    broadcast_naive_block(dst_ptr, src_ptr, nbytes, tl.program_id(0), tl.num_programs(0))
+
+
+# below this size NVLS broadcast is latency bound and the copy engine is faster
+NVLS_MIN_NBYTES_PER_RANK = 1024 * 1024
+
+
+def nvls_producer_all_gather_intra_node(
+    rank,
+    num_ranks,
+    local_tensor: torch.Tensor,
+    remote_tensor_buffers: List[torch.Tensor],
+    barrier_buffers: List[torch.Tensor],
+    stream: torch.cuda.Stream,
+    for_correctness=False,
+    num_blocks=16,
+):
+    """ each rank broadcasts its local tensor with one multimem.st per 16 bytes, instead of num_ranks - 1 unicast copies.
+        requires NVLS hardware and NVSHMEM multicast support (NVSHMEM_DISABLE_CUDA_VMM=0).
+    """
+    M_per_rank, N = local_tensor.shape
+    nbytes_per_rank = local_tensor.nbytes
+    if nbytes_per_rank < NVLS_MIN_NBYTES_PER_RANK:
+        return cp_engine_producer_all_gather_full_mesh_pull(rank, num_ranks, local_tensor, remote_tensor_buffers,
+                                                            barrier_buffers, stream, for_correctness=for_correctness)
+
+    assert local_tensor.is_contiguous() and nbytes_per_rank % 16 == 0
+    dst = remote_tensor_buffers[rank][rank * M_per_rank:(rank + 1) * M_per_rank, :]
+    with torch.cuda.stream(stream):
+        if for_correctness:
+            # fake a slow communication case
+            # test if the computation is waiting for the correct communication
+            _add_noise_workload_debug()
+        nvls_broadcast_kernel[(num_blocks, )](dst, local_tensor, nbytes_per_rank, num_warps=32)
+        for dst_rank in range(num_ranks):
+            if dst_rank == rank:
+                continue
+            set_signal(barrier_buffers[dst_rank][rank].data_ptr(), 1, stream,
+                       require_i64=barrier_buffers[dst_rank].dtype == torch.uint64)
+
+
 def cp_engine_producer_all_gather_intra_node(
     rank,
     num_ranks,
@@ -274,6 +322,8 @@ def cp_engine_producer_all_gather_intra_node(
         fn = cp_engine_producer_all_gather_ring_push_1d
     elif all_gather_method == AllGatherMethod.Ring2D_IntraNode:
         fn = cp_engine_producer_all_gather_ring_push_numa_2d
+    elif all_gather_method == AllGatherMethod.NVLS_IntraNode:
+        fn = nvls_producer_all_gather_intra_node
     else:
         raise Exception(f"Unsupported allgather method: {all_gather_method}")
 
@@ -387,7 +437,27 @@ def nvshmem_device_producer_all_gather_2d_put_block_kernel(
     DISPATCH_BLOCK_NUM: tl.constexpr,
     SEND_BLOCK_NUM: tl.constexpr,
 ):
-    pid = tl.program_id(axis=0)
+    all_gather_2d_put_block(tl.program_id(axis=0), ag_buffer_ptr, signal_buffer_ptr, elem_per_rank, size_per_elem,
+                            signal_target, rank, local_world_size, world_size, DISPATCH_BLOCK_NUM, SEND_BLOCK_NUM)
+
+
+@triton.jit
+def all_gather_2d_put_block(
+    pid,
+    ag_buffer_ptr,
+    signal_buffer_ptr,
+    elem_per_rank,
+    size_per_elem,
+    signal_target,
+    rank,
+    local_world_size,
+    world_size,
+    DISPATCH_BLOCK_NUM: tl.constexpr,
+    SEND_BLOCK_NUM: tl.constexpr,
+):
+    """ the work of block pid of `nvshmem_device_producer_all_gather_2d_put_block_kernel`, for
+        DISPATCH_BLOCK_NUM + SEND_BLOCK_NUM blocks. callable from other kernels that reserve blocks for the allgather.
+    """
     thread_idx = tid(axis=0)
 
     n_nodes = world_size // local_world_size
@@ -549,6 +619,45 @@ def cp_engine_producer_all_gather_full_mesh_pull_inter_node(
     intranode_ag_stream.wait_stream(internode_ag_stream)
 
 
+@triton.jit
+def set_signals_kernel(signal_ptr, num_signals, signal_target, BLOCK_SIZE: tl.constexpr):
+    offs = tl.arange(0, BLOCK_SIZE)
+    tl.store(signal_ptr + offs, signal_target, mask=offs < num_signals)
+
+
+# above this size NCCL's ring allgather outruns the NVSHMEM put kernels across nodes
+NCCL_MIN_NBYTES_PER_RANK = 8 * 1024 * 1024
+
+
+def nccl_producer_all_gather_inter_node(
+    rank,
+    local_world_size,
+    world_size,
+    local_tensor: torch.Tensor,
+    ag_buffer: list[torch.Tensor],
+    signal_buffer: list[torch.Tensor],
+    stream: torch.cuda.Stream,
+    group,
+    signal_target=1,
+    for_correctness=False,
+):
+    """ allgather with NCCL into the local ag_buffer, then raise the ready flags of all ranks at once.
+        the consumer can not start any tile before the whole allgather is done, so this only pays off for
+        payloads large enough that the bandwidth gain outweighs the lost overlap.
+    """
+    local_rank = rank % local_world_size
+    M_per_rank, _ = local_tensor.shape
+    with torch.cuda.stream(stream):
+        if for_correctness:
+            # fake a slow communication case
+            # test if the computation is waiting for the correct communication
+            _add_noise_workload_debug()
+        torch.distributed.all_gather_into_tensor(ag_buffer[local_rank][:M_per_rank * world_size], local_tensor,
+                                                 group=group)
+        set_signals_kernel[(1, )](signal_buffer[local_rank], world_size, signal_target,
+                                  BLOCK_SIZE=triton.next_power_of_2(world_size))
+
+
 def inter_node_allgather(
     local_tensor: torch.Tensor,
     ag_buffer: list[torch.Tensor],
@@ -562,11 +671,19 @@ def inter_node_allgather(
     cpengine_dispatch=False,
     all_gather_method: AllGatherMethod = AllGatherMethod.All2All_InterNode,
     for_correctness: bool = False,
+    nccl_group=None,
 ):
     local_rank = rank % local_world_size
     n_nodes = world_size // local_world_size
     M_per_rank, N = local_tensor.shape
-    if all_gather_method == AllGatherMethod.All2All_InterNode:
+    if nccl_group is not None and n_nodes > 1 and local_tensor.nbytes >= NCCL_MIN_NBYTES_PER_RANK:
+        all_gather_method = AllGatherMethod.NCCL_InterNode
+    if all_gather_method == AllGatherMethod.NCCL_InterNode:
+        assert nccl_group is not None, "NCCL_InterNode requires nccl_group"
+        nccl_producer_all_gather_inter_node(rank, local_world_size, world_size, local_tensor, ag_buffer, signal_buffer,
+                                            intranode_ag_stream, nccl_group, signal_target=signal_target,
+                                            for_correctness=for_correctness)
+    elif all_gather_method == AllGatherMethod.All2All_InterNode:
         if not cpengine_dispatch:
             with torch.cuda.stream(internode_ag_stream):
                 grid = lambda META: (int(local_world_size + n_nodes - 2), )
@@ -22,21 +22,23 @@
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 #
 ################################################################################
+import functools
 import torch
 import triton
 import triton.language as tl
 import triton_dist.language as dl
+from triton.language.extra import libshmem_device
 from triton.language.extra.cuda.language_extra import tid, st
 from triton_dist import pynvshmem
 
 from typing import Optional, List
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
-from triton_dist.kernels.nvidia.common_ops import set_signal, barrier_all_intra_node_non_atomic
-from triton_dist.kernels.nvidia.allgather import AllGatherMethod, cp_engine_producer_all_gather_intra_node, get_auto_all_gather_method, inter_node_allgather, cp_engine_producer_all_gather_full_mesh_pull
+from triton_dist.kernels.nvidia.common_ops import tree_barrier_intra_node, multi_flag_wait
+from triton_dist.kernels.nvidia.allgather import AllGatherMethod, cp_engine_producer_all_gather_intra_node, get_auto_all_gather_method, inter_node_allgather, cp_engine_producer_all_gather_full_mesh_pull, cp_engine_producer_all_gather_full_mesh_push, all_gather_2d_put_block
 
 
-@triton.jit(do_not_specialize=["rank"])
+@triton.jit
 def copy_kernel(
     rank,
     local_buf_ptr,
@@ -44,76 +46,336 @@ def copy_kernel(
     M_per_rank,
     N,
     stride_local_m,
-    stride_local_n,
     stride_global_m,
-    stride_global_n,
     BLOCK_SIZE_M: tl.constexpr,
     BLOCK_SIZE_N: tl.constexpr,
 ):
+    """ rows are expected to be contiguous, so each thread moves 16 bytes per load/store """
     sm_id = tl.program_id(axis=0)
     num_pid_n = tl.cdiv(N, BLOCK_SIZE_N)
 
     pid_m = sm_id // num_pid_n
     pid_n = sm_id % num_pid_n
 
-    offs_m = tl.arange(0, BLOCK_SIZE_M)
-    offs_n = tl.arange(0, BLOCK_SIZE_N)
-    data_ptr = local_buf_ptr + (pid_m * BLOCK_SIZE_M + offs_m[:, None]) * stride_local_m + (
-        pid_n * BLOCK_SIZE_N + offs_n[None, :]) * stride_local_n
-    dst_ptr = global_buf_ptr + (rank * M_per_rank + pid_m * BLOCK_SIZE_M + offs_m[:, None]) * stride_global_m + (
-        pid_n * BLOCK_SIZE_N + offs_n[None, :]) * stride_global_n
-    mask_data = (pid_m * BLOCK_SIZE_M + offs_m[:, None] < M_per_rank) & (pid_n * BLOCK_SIZE_N + offs_n[None, :] < N)
-    mask_dst = (pid_m * BLOCK_SIZE_M + offs_m[:, None] < M_per_rank) & (pid_n * BLOCK_SIZE_N + offs_n[None, :] < N)
+    offs_m = pid_m * BLOCK_SIZE_M + tl.arange(0, BLOCK_SIZE_M)
+    offs_n = tl.max_contiguous(tl.multiple_of(pid_n * BLOCK_SIZE_N + tl.arange(0, BLOCK_SIZE_N), BLOCK_SIZE_N),
+                               BLOCK_SIZE_N)
+    data_ptr = local_buf_ptr + offs_m[:, None] * stride_local_m + offs_n[None, :]
+    dst_ptr = global_buf_ptr + (rank * M_per_rank + offs_m[:, None]) * stride_global_m + offs_n[None, :]
+    mask = (offs_m[:, None] < M_per_rank) & (offs_n[None, :] < N)
 
-    data = tl.load(data_ptr, mask=mask_data)
-    tl.store(dst_ptr, data, mask=mask_dst)
+    data = tl.load(data_ptr, mask=mask)
+    tl.store(dst_ptr, data, mask=mask)
 
 
-@triton.jit(do_not_specialize=["rank", "num_ranks", "flag_value"])
-def copy_and_barrier_all_inter_node_kernel(
+@triton.jit(do_not_specialize=["num_ranks"])
+def copy_and_set_ready_inter_node_kernel(
     rank,
     num_ranks,
     local_buf_ptr,
     global_buf_ptr,
     symm_barrier_ptr,
-    symm_sync_ptr,
     M_per_rank,
     N,
     stride_local_m,
-    stride_local_n,
     stride_global_m,
-    stride_global_n,
-    flag_value,
     BLOCK_SIZE_M: tl.constexpr,
     BLOCK_SIZE_N: tl.constexpr,
 ):
-    barrier_all_intra_node_non_atomic(rank, num_ranks, symm_sync_ptr, flag_value)
-    copy_kernel(rank, local_buf_ptr, global_buf_ptr, M_per_rank, N, stride_local_m, stride_local_n, stride_global_m,
-                stride_global_n, BLOCK_SIZE_M, BLOCK_SIZE_N)
+    """ resets the symm barrier in-kernel, so no separate memset is launched. the local flag is consumed by
+    kernels ordered after this one on the stream, so it can be raised before the copy finishes """
+    if tl.program_id(axis=0) == 0:
+        thread_idx = tid(0)
+        if thread_idx < num_ranks:
+            st(symm_barrier_ptr + thread_idx, 1 if thread_idx == rank else 0)
+    copy_kernel(rank, local_buf_ptr, global_buf_ptr, M_per_rank, N, stride_local_m, stride_global_m, BLOCK_SIZE_M,
+                BLOCK_SIZE_N)
+
+
+@triton.jit(do_not_specialize=["rank", "num_ranks"])
+def set_ready_and_put_scales_inter_node_kernel(
+    rank,
+    num_ranks,
+    symm_barrier_ptr,
+    symm_scale_ptr,
+    M_per_rank,
+):
+    """ fp8 counterpart of the flag reset in `copy_and_set_ready_inter_node_kernel`. program pid also puts this
+    rank's row scales into peer pid, the rows themselves travel with the allgather """
+    pid = tl.program_id(axis=0)
+    if pid == 0:
+        thread_idx = tid(0)
+        if thread_idx < num_ranks:
+            st(symm_barrier_ptr + thread_idx, 1 if thread_idx == rank else 0)
+    if pid != rank:
+        libshmem_device.putmem_block(symm_scale_ptr + rank * M_per_rank, symm_scale_ptr + rank * M_per_rank,
+                                     M_per_rank * 4, pid)
+
+
+@triton.jit(do_not_specialize=["rank", "num_ranks"])
+def barrier_all_intra_node_on_phase_kernel(
+    rank,
+    num_ranks,
+    symm_sync_ptr,
+    phase_ptr,
+):
+    """ phase_ptr holds the last barrier value used, the next two are taken by this kernel and
+        `set_ready_and_barrier_all_intra_node_kernel` """
+    tree_barrier_intra_node(rank, num_ranks, symm_sync_ptr, tl.load(phase_ptr) + 1)
+
+
+@triton.jit(do_not_specialize=["rank", "num_ranks"])
+def set_ready_and_barrier_all_intra_node_kernel(
+    rank,
+    num_ranks,
+    symm_barrier_ptr,
+    symm_sync_ptr,
+    phase_ptr,
+):
+    phase = tl.load(phase_ptr) + 2
+    thread_idx = tid(0)
+    if thread_idx < num_ranks:  # set symm barrier
+        st(symm_barrier_ptr + thread_idx, 1 if thread_idx == rank else 0)
+    tree_barrier_intra_node(rank, num_ranks, symm_sync_ptr, phase)
+    # every thread has read phase_ptr before the barrier, advance it for the next call
+    if thread_idx == 0:
+        tl.store(phase_ptr, phase)
+
+
+@triton.jit(do_not_specialize=["rank", "num_ranks"])
+def set_ready_and_notify_peers_intra_node_kernel(
+    rank,
+    num_ranks,
+    symm_barrier_ptr,
+    symm_slot_ready_ptr,
+    phase_ptr,
+):
+    """ instead of a second barrier, tell every peer that our slot is staged: the peer's allgather waits on
+        symm_slot_ready_ptr[rank] before pulling it and re-arms the flag, see `cp_engine_producer_all_gather_full_mesh_pull`
+    """
+    phase = tl.load(phase_ptr) + 2
     thread_idx = tid(0)
     if thread_idx < num_ranks:  # set symm barrier
         st(symm_barrier_ptr + thread_idx, 1 if thread_idx == rank else 0)
-    barrier_all_intra_node_non_atomic(rank, num_ranks, symm_sync_ptr, flag_value + 1)
+        st(dl.symm_at(symm_slot_ready_ptr + rank, thread_idx), 1, scope="sys", semantic="release")
+    if thread_idx == 0:
+        tl.store(phase_ptr, phase)
+
+
+@triton.jit(do_not_specialize=["rank", "num_ranks"])
+def reset_ready_and_barrier_all_intra_node_kernel(
+    rank,
+    num_ranks,
+    symm_barrier_ptr,
+    symm_sync_ptr,
+    phase_ptr,
+):
+    """ for push-based allgather: peers raise our flags once they pass the barrier, so reset them before it """
+    phase = tl.load(phase_ptr)
+    thread_idx = tid(0)
+    if thread_idx < num_ranks:
+        st(symm_barrier_ptr + thread_idx, 0)
+    tree_barrier_intra_node(rank, num_ranks, symm_sync_ptr, phase + 1)
+    # take two barrier values like the copy-and-barrier path, so both can share one phase counter
+    if thread_idx == 0:
+        tl.store(phase_ptr, phase + 2)
+
 
+def _slot_ready_buf(comm_buf, num_ranks):
+    """ comm_buf[num_ranks:2 * num_ranks] is left unused by `tree_barrier_intra_node`, one flag per source rank """
+    return comm_buf[num_ranks:2 * num_ranks]
 
-def local_copy_and_barrier_all(rank, num_ranks, local_data, global_data, comm_buf, barrier_ptr, M_per_rank, N, phase,
-                               is_internode: bool = False):
+
+def local_copy_and_barrier_all(rank, num_ranks, local_data, global_data, comm_buf, barrier_ptr, M_per_rank, N,
+                               phase_ptr, is_internode: bool = False, notify_peers: bool = False):
+    """ phase_ptr is an int32 device counter of barrier values, advanced on the GPU. unused by the inter-node path.
+
+    with notify_peers, the intra-node path skips the second barrier and signals each peer once the local slot
+    is staged. the allgather must then wait on `_slot_ready_buf(comm_buf, num_ranks)` before pulling a slot.
+    """
     if not is_internode:
-        grid = lambda META: (triton.cdiv(M_per_rank, META["BLOCK_SIZE_M"]) * triton.cdiv(N, META["BLOCK_SIZE_N"]), )
-        copy_and_barrier_all_inter_node_kernel[grid](rank, num_ranks, local_data, global_data, barrier_ptr, comm_buf,
-                                                     M_per_rank, N, local_data.stride(0), local_data.stride(1),
-                                                     global_data.stride(0), global_data.stride(1), phase, 128, 256)
+        # peers pull from our slot, so wait until they are done with the previous round before overwriting it
+        barrier_all_intra_node_on_phase_kernel[(1, )](rank, num_ranks, comm_buf, phase_ptr)
+        # the local slot is filled by the copy engine, leaving the SMs to the GEMM
+        global_data[rank * M_per_rank:(rank + 1) * M_per_rank, :].copy_(local_data)
+        if notify_peers:
+            set_ready_and_notify_peers_intra_node_kernel[(1, )](rank, num_ranks, barrier_ptr,
+                                                                _slot_ready_buf(comm_buf, num_ranks), phase_ptr)
+        else:
+            set_ready_and_barrier_all_intra_node_kernel[(1, )](rank, num_ranks, barrier_ptr, comm_buf, phase_ptr)
 
     else:
+        # peers push into our buffer and raise our flags: every signal of the previous round must have landed
+        # before the flags are reset, and the reset must be visible before any peer starts the next round.
         pynvshmem.nvshmemx_barrier_all_on_stream(torch.cuda.current_stream().cuda_stream)
-        barrier_ptr.fill_(0)
-        grid = lambda META: (triton.cdiv(M_per_rank, META["BLOCK_SIZE_M"]) * triton.cdiv(N, META["BLOCK_SIZE_N"]), )
-        copy_kernel[grid](rank, local_data, global_data, M_per_rank, N, local_data.stride(0), local_data.stride(1),
-                          global_data.stride(0), global_data.stride(1), 128, 256)
-        set_signal(barrier_ptr[rank].data_ptr(), 1, torch.cuda.current_stream(), is_internode)
+        BLOCK_SIZE_M, BLOCK_SIZE_N = 128, 256
+        grid = (triton.cdiv(M_per_rank, BLOCK_SIZE_M) * triton.cdiv(N, BLOCK_SIZE_N), )
+        assert local_data.stride(1) == 1 and global_data.stride(1) == 1
+        copy_and_set_ready_inter_node_kernel[grid](rank, num_ranks, local_data, global_data, barrier_ptr, M_per_rank, N,
+                                                   local_data.stride(0), global_data.stride(0), BLOCK_SIZE_M,
+                                                   BLOCK_SIZE_N)
         pynvshmem.nvshmemx_barrier_all_on_stream(torch.cuda.current_stream().cuda_stream)
 
 
+def reset_ready_and_barrier_all(rank, num_ranks, comm_buf, barrier_ptr, phase_ptr):
+    """ intra-node only. with copy_engine_dispatch the allgather pushes the local tensor into every slot,
+        own slot included, so nothing is staged here: the barrier only keeps peers from overwriting a slot
+        that is still being read by the previous GEMM.
+    """
+    reset_ready_and_barrier_all_intra_node_kernel[(1, )](rank, num_ranks, barrier_ptr, comm_buf, phase_ptr)
+
+
+@triton.jit
+def quantize_fp8_per_row_kernel(
+    x_ptr,
+    out_ptr,
+    scale_ptr,
+    K,
+    stride_x,
+    stride_out,
+    BLOCK_SIZE: tl.constexpr,
+):
+    row = tl.program_id(axis=0)
+    offs = tl.arange(0, BLOCK_SIZE)
+    amax = tl.zeros((BLOCK_SIZE, ), dtype=tl.float32)
+    for k in range(0, K, BLOCK_SIZE):
+        x = tl.load(x_ptr + row * stride_x + k + offs, mask=k + offs < K, other=0.0).to(tl.float32)
+        amax = tl.maximum(amax, tl.abs(x))
+    scale = tl.maximum(tl.max(amax), 1e-12) / 448.0  # max normal of fp8 e4m3
+    for k in range(0, K, BLOCK_SIZE):
+        x = tl.load(x_ptr + row * stride_x + k + offs, mask=k + offs < K, other=0.0).to(tl.float32)
+        tl.store(out_ptr + row * stride_out + k + offs, (x / scale).to(out_ptr.dtype.element_ty), mask=k + offs < K)
+    tl.store(scale_ptr + row, scale)
+
+
+def local_quantize_fp8_and_barrier_all(rank, num_ranks, local_data, global_data, global_scale, comm_buf, barrier_ptr,
+                                       M_per_rank, K, phase_ptr, notify_peers: bool = False,
+                                       is_internode: bool = False):
+    """ same as local_copy_and_barrier_all, but stages the local slot as fp8 with per-row scales.
+
+    inter-node, the scales are put to every rank before the closing barrier, which also waits for their delivery,
+    so only the fp8 rows go through the allgather.
+    """
+    if is_internode:
+        current_stream = torch.cuda.current_stream()
+        pynvshmem.nvshmemx_barrier_all_on_stream(current_stream.cuda_stream)
+        quantize_fp8_per_row_kernel[(M_per_rank, )](local_data, global_data[rank * M_per_rank:],
+                                                    global_scale[rank * M_per_rank:], K, local_data.stride(0),
+                                                    global_data.stride(0), BLOCK_SIZE=1024)
+        set_ready_and_put_scales_inter_node_kernel[(num_ranks, )](rank, num_ranks, barrier_ptr, global_scale,
+                                                                  M_per_rank)
+        pynvshmem.nvshmemx_barrier_all_on_stream(current_stream.cuda_stream)
+        return
+
+    barrier_all_intra_node_on_phase_kernel[(1, )](rank, num_ranks, comm_buf, phase_ptr)
+    quantize_fp8_per_row_kernel[(M_per_rank, )](local_data, global_data[rank * M_per_rank:],
+                                                global_scale[rank * M_per_rank:], K, local_data.stride(0),
+                                                global_data.stride(0), BLOCK_SIZE=1024)
+    if notify_peers:
+        set_ready_and_notify_peers_intra_node_kernel[(1, )](rank, num_ranks, barrier_ptr,
+                                                            _slot_ready_buf(comm_buf, num_ranks), phase_ptr)
+    else:
+        set_ready_and_barrier_all_intra_node_kernel[(1, )](rank, num_ranks, barrier_ptr, comm_buf, phase_ptr)
+
+
+@functools.lru_cache()
+def _sm_count(device_index: int):
+    return torch.cuda.get_device_properties(device_index).multi_processor_count
+
+
+@functools.lru_cache()
+def _get_default_ag_stream(device_index: int):
+    """ allgather stream of the ops called without one, created once per device instead of once per call """
+    return torch.cuda.Stream(device_index)
+
+
+@functools.lru_cache()
+def _get_fence_event(device_index: int):
+    return torch.cuda.Event()
+
+
+def _fence(src_stream, *dst_streams):
+    """ like dst.wait_stream(src_stream) for each dst, with one reused event instead of a new one per wait.
+        a wait captures the event state when enqueued, so the event can be recorded again right after.
+    """
+    event = _get_fence_event(torch.cuda.current_device())
+    event.record(src_stream)
+    for dst_stream in dst_streams:
+        dst_stream.wait_event(event)
+
+
+_tma_scratch = {}
+
+
+def _grow_scratch(scratch_per_stream, size, stream, retired=None):
+    """ one growing scratch per stream: launches on a stream run in order, and each one writes its descriptors
+        before reading them, so the previous launch's descriptors can be overwritten. a replaced scratch is kept
+        in retired if given, instead of being freed.
+    """
+    scratch = scratch_per_stream.get(stream, None)
+    if scratch is None or scratch.numel() < size:
+        if scratch is not None and retired is not None:
+            retired.append(scratch)
+        scratch = torch.empty(size, device="cuda", dtype=torch.int8)
+        scratch_per_stream[stream] = scratch
+    return scratch[:size]
+
+
+# TMA descriptors require a global memory allocation
+def _tma_alloc_fn(size: int, alignment: int, stream: Optional[int]):
+    """ scratch of the ops called without a context, shared by all of them """
+    return _grow_scratch(_tma_scratch, size, stream)
+
+
+@functools.lru_cache()
+def _get_swizzle_rank_lut(rank: int, num_ranks: int, local_world_size: int, device_index: int):
+    """ m_rank -> the rank whose rows are computed in its place, so every rank starts from its own node and rows.
+        None on a single node, where the kernel swizzles without a table.
+    """
+    node_id = rank // local_world_size
+    nnodes = num_ranks // local_world_size
+    if nnodes <= 1:
+        return None
+    lut = [((m_rank // local_world_size + node_id) % nnodes) * local_world_size +
+           (m_rank % local_world_size + rank) % local_world_size for m_rank in range(num_ranks)]
+    return torch.tensor(lut, dtype=torch.int32, device=f"cuda:{device_index}")
+
+
+@functools.lru_cache()
+def _use_dynamic_tile_schedule(device_index: int):
+    """ dynamic tile scheduling in persistent GEMM is enabled on Blackwell (sm100) and later. Hopper keeps the static schedule. """
+    return torch.cuda.get_device_capability(device_index) >= (10, 0)
+
+
+def _create_tile_counter(device):
+    """ tile queue of the persistent GEMM: [next_tile_id, num_exited_programs]. reset by the kernel itself on exit.
+        launches that may overlap, on other streams or in other contexts, must not share one.
+    """
+    return torch.zeros([2], dtype=torch.int32, device=device)
+
+
+@functools.lru_cache()
+def _get_stream_tile_counter(device_index: int, stream: int):
+    """ tile queue shared by the launches on one stream, which run one after the other. zeroed on that stream. """
+    with torch.cuda.stream(torch.cuda.ExternalStream(stream, device=device_index)):
+        return _create_tile_counter(torch.device("cuda", device_index))
+
+
+def _resolve_tile_counter(tile_counter, dynamic_tile_schedule, device_index, stream):
+    """ the given tile queue, or the one of the stream the GEMM runs on. None without dynamic tile scheduling. """
+    if not dynamic_tile_schedule:
+        return None
+    return tile_counter if tile_counter is not None else _get_stream_tile_counter(device_index, stream.cuda_stream)
+
+
+@functools.lru_cache()
+def _get_fake_barrier(num_ranks: int, device_index: int):
+    """ all-ready flags for `gemm_persistent`/`gemm_non_persistent`. only ever read, so shared by all contexts. """
+    # padded to whole 16B chunks, which `multi_flag_wait` reads
+    flags = torch.ones([triton.cdiv(num_ranks, 2) * 2], dtype=torch.int64, device=torch.device("cuda", device_index))
+    return flags[:num_ranks].view(torch.uint64)
+
+
 # TMA related test
 def _matmul_launch_metadata(grid, kernel, args):
     ret = {}
@@ -128,7 +390,106 @@ def _matmul_launch_metadata(grid, kernel, args):
     return ret
 
 
-@triton.jit(launch_metadata=_matmul_launch_metadata)
+def _even_group_m(M, BLOCK_SIZE_M, GROUP_SIZE_M):
+    """ whether every GROUP_SIZE_M group of M tiles is full, so the tile swizzle needs no runtime division """
+    return triton.cdiv(M, BLOCK_SIZE_M) % GROUP_SIZE_M == 0
+
+
+@triton.jit
+def _compute_pid_m_n(tile_id, num_pid_m, num_pid_n, pid_ms_per_rank, rank, num_ranks, GROUP_SIZE_M: tl.constexpr,
+                     LOCAL_WORLD_SIZE: tl.constexpr, swizzle_lut_ptr, EVEN_GROUP_M: tl.constexpr):
+    nnodes = num_ranks // LOCAL_WORLD_SIZE
+    num_pid_in_group = GROUP_SIZE_M * num_pid_n
+    group_id = tile_id // num_pid_in_group
+    first_pid_m = group_id * GROUP_SIZE_M
+    if EVEN_GROUP_M:
+        # every group is full: the modulo and division below are by a constexpr
+        group_size_m = GROUP_SIZE_M
+    else:
+        group_size_m = min(num_pid_m - first_pid_m, GROUP_SIZE_M)
+    pid_m = first_pid_m + (tile_id % group_size_m)
+    pid_n = (tile_id % num_pid_in_group) // group_size_m
+
+    # swizzle m. fewer ranks than LOCAL_WORLD_SIZE still fit on one node
+    if nnodes <= 1:
+        alpha = 0
+        beta = 0
+        pid_m = (pid_m + ((((rank ^ alpha) + beta) % num_ranks) * pid_ms_per_rank)) % num_pid_m
+    else:
+        m_rank = pid_m // pid_ms_per_rank
+        pid_m_intra_rank = pid_m - m_rank * pid_ms_per_rank
+        if swizzle_lut_ptr is None:
+            node_id = rank // LOCAL_WORLD_SIZE
+            m_node_id = m_rank // LOCAL_WORLD_SIZE
+            m_local_rank = m_rank % LOCAL_WORLD_SIZE
+            swizzle_m_node_id = (m_node_id + node_id) % nnodes
+            swizzle_m_local_rank = (m_local_rank + rank) % LOCAL_WORLD_SIZE
+            swizzle_m_rank = swizzle_m_node_id * LOCAL_WORLD_SIZE + swizzle_m_local_rank
+        else:
+            # rank-level swizzle is precomputed by `_get_swizzle_rank_lut`
+            swizzle_m_rank = tl.load(swizzle_lut_ptr + m_rank)
+
+        pid_m = swizzle_m_rank * pid_ms_per_rank + pid_m_intra_rank
+    return pid_m, pid_n
+
+
+@triton.jit
+def _wait_ranks_ready(ready_ptr, ready_mask, rank_beg, rank_end, ready_value: tl.constexpr):
+    """ wait for the A rows of ranks [rank_beg, rank_end]. ready flags only go up within a launch, so ranks already
+        recorded in ready_mask are not polled again. returns the token and the updated ready_mask.
+    """
+    num_ranks_to_wait = rank_end - rank_beg + 1
+    bits = ((tl.full([], 1, tl.int64) << num_ranks_to_wait.to(tl.int64)) - 1) << rank_beg.to(tl.int64)
+    flag_end = tl.where((ready_mask & bits) == bits, rank_beg - 1, rank_end)
+    token = multi_flag_wait(ready_ptr, rank_beg, flag_end, ready_value)
+    return token, ready_mask | bits
+
+
+@triton.jit
+def _load_ab_tiles(a_desc, b_desc, offs_am, offs_bn, offs_k, A_FP8: tl.constexpr):
+    a = a_desc.load([offs_am, offs_k])
+    b = b_desc.load([offs_bn, offs_k])
+    if A_FP8:
+        # A is gathered as fp8, its row scales are applied in the epilogue
+        a = a.to(b.dtype)
+    # B is stored [N, K] with K contiguous, which is the K-major B operand the MMA reads natively: the transpose
+    # only permutes the shared memory descriptor, no data is moved
+    return a, b.T
+
+
+@triton.jit
+def _load_a_scale(a_scale_ptr, token, offs_am, M, BLOCK_SIZE_M: tl.constexpr):
+    offs_m = offs_am + tl.arange(0, BLOCK_SIZE_M)
+    a_scale = tl.load(dl.consume_token(a_scale_ptr + offs_m, token), mask=offs_m < M, other=0.0)
+    return a_scale[:, None]
+
+
+@triton.jit
+def _store_c_tile(c_desc, accumulator, offs_am, offs_bn, dtype: tl.constexpr, BLOCK_SIZE_M: tl.constexpr,
+                  BLOCK_SIZE_N: tl.constexpr, EPILOGUE_SUBTILE: tl.constexpr, a_scale=None):
+    """ a_scale, if given, is applied to each subtile right before its cast, so no scaled copy of the whole
+        accumulator is kept live """
+    if EPILOGUE_SUBTILE:
+        acc = tl.reshape(accumulator, (BLOCK_SIZE_M, 2, BLOCK_SIZE_N // 2))
+        acc = tl.permute(acc, (0, 2, 1))
+        acc0, acc1 = tl.split(acc)
+        if a_scale is not None:
+            acc0 = acc0 * a_scale
+        c0 = acc0.to(dtype)
+        c_desc.store([offs_am, offs_bn], c0)
+        if a_scale is not None:
+            acc1 = acc1 * a_scale
+        c1 = acc1.to(dtype)
+        c_desc.store([offs_am, offs_bn + BLOCK_SIZE_N // 2], c1)
+    else:
+        if a_scale is not None:
+            accumulator = accumulator * a_scale
+        c = accumulator.to(dtype)
+        c_desc.store([offs_am, offs_bn], c)
+
+
+@triton.heuristics({"EVEN_GROUP_M": lambda args: _even_group_m(args["M"], args["BLOCK_SIZE_M"], args["GROUP_SIZE_M"])})
+@triton.jit(launch_metadata=_matmul_launch_metadata, do_not_specialize=["NUM_SMS"])
 def kernel_consumer_gemm_persistent(a_ptr, b_ptr, c_ptr,  #
                                     M, N, K,  #
                                     rank: tl.constexpr, num_ranks: tl.constexpr, ready_ptr, comm_buf_ptr,
@@ -137,18 +498,39 @@ def kernel_consumer_gemm_persistent(a_ptr, b_ptr, c_ptr,  #
                                     BLOCK_SIZE_K: tl.constexpr,  #
                                     GROUP_SIZE_M: tl.constexpr,  #
                                     EPILOGUE_SUBTILE: tl.constexpr,  #
-                                    NUM_SMS: tl.constexpr, ready_value: tl.constexpr = 1,
-                                    LOCAL_WORLD_SIZE: tl.constexpr = 8):  #
+                                    NUM_SMS, ready_value: tl.constexpr = 1, LOCAL_WORLD_SIZE: tl.constexpr = 8,
+                                    tile_counter_ptr=None, DYNAMIC_TILE_SCHEDULE: tl.constexpr = False,
+                                    WARP_SPECIALIZE: tl.constexpr = False, a_scale_ptr=None,
+                                    A_FP8: tl.constexpr = False, swizzle_lut_ptr=None,
+                                    EVEN_GROUP_M: tl.constexpr = False):  #
+    # NUM_SMS is the grid size, kept as a runtime argument for the autotune key: it varies with M when the programs
+    # are balanced over the tiles, and a constexpr would compile the kernel again for every value.
+    _consumer_gemm_persistent_tiles(tl.program_id(axis=0), tl.num_programs(axis=0), a_ptr, b_ptr, c_ptr, M, N, K, rank,
+                                    num_ranks, ready_ptr, BLOCK_SIZE_M, BLOCK_SIZE_N, BLOCK_SIZE_K, GROUP_SIZE_M,
+                                    EPILOGUE_SUBTILE, ready_value, LOCAL_WORLD_SIZE, tile_counter_ptr,
+                                    DYNAMIC_TILE_SCHEDULE, WARP_SPECIALIZE, a_scale_ptr, A_FP8, swizzle_lut_ptr,
+                                    EVEN_GROUP_M)
+
+
+@triton.jit
+def _consumer_gemm_persistent_tiles(start_pid, num_programs, a_ptr, b_ptr, c_ptr, M, N, K, rank: tl.constexpr,
+                                    num_ranks: tl.constexpr, ready_ptr, BLOCK_SIZE_M: tl.constexpr,
+                                    BLOCK_SIZE_N: tl.constexpr, BLOCK_SIZE_K: tl.constexpr, GROUP_SIZE_M: tl.constexpr,
+                                    EPILOGUE_SUBTILE: tl.constexpr, ready_value: tl.constexpr,
+                                    LOCAL_WORLD_SIZE: tl.constexpr, tile_counter_ptr,
+                                    DYNAMIC_TILE_SCHEDULE: tl.constexpr, WARP_SPECIALIZE: tl.constexpr, a_scale_ptr,
+                                    A_FP8: tl.constexpr, swizzle_lut_ptr, EVEN_GROUP_M: tl.constexpr):
+    """ the GEMM of program start_pid out of num_programs persistent programs """
     # Matmul using TMA and device-side descriptor creation
     dtype = c_ptr.dtype.element_ty
-    start_pid = tl.program_id(axis=0)
     num_pid_m = tl.cdiv(M, BLOCK_SIZE_M)
     num_pid_n = tl.cdiv(N, BLOCK_SIZE_N)
     k_tiles = tl.cdiv(K, BLOCK_SIZE_K)
     num_tiles = num_pid_m * num_pid_n
-    node_id = rank // LOCAL_WORLD_SIZE
-    nnodes = num_ranks // LOCAL_WORLD_SIZE
 
+    # TMA descriptors stage tiles in NVMMA-swizzled shared memory; with a K tile of at least 128 bytes the
+    # 128B swizzle is selected, which keeps the MMA operand reads free of bank conflicts. narrower K tiles still
+    # work on a narrower swizzle, `pick_config` and the autotune prune only pick 128B ones.
     a_desc = tl.make_tensor_descriptor(
         a_ptr,
         shape=[M, K],
@@ -171,85 +553,108 @@ def kernel_consumer_gemm_persistent(a_ptr, b_ptr, c_ptr,  #
         ],
     )
 
-    tiles_per_SM = num_tiles // NUM_SMS
-    if start_pid < num_tiles % NUM_SMS:
-        tiles_per_SM += 1
-
-    tile_id = start_pid - NUM_SMS
-    ki = -1
-
-    pid_m = 0
-    pid_n = 0
-    offs_am = 0
-    offs_bn = 0
-
     M_per_rank = M // num_ranks
     pid_ms_per_rank = tl.cdiv(M_per_rank, BLOCK_SIZE_M)
-
-    num_pid_in_group = GROUP_SIZE_M * num_pid_n
-
-    accumulator = tl.zeros((BLOCK_SIZE_M, BLOCK_SIZE_N), dtype=tl.float32)
-
-    for _ in range(0, k_tiles * tiles_per_SM):
-        ki = tl.where(ki == k_tiles - 1, 0, ki + 1)
-        if ki == 0:
-            tile_id += NUM_SMS
-            group_id = tile_id // num_pid_in_group
-            first_pid_m = group_id * GROUP_SIZE_M
-            group_size_m = min(num_pid_m - first_pid_m, GROUP_SIZE_M)
-            pid_m = first_pid_m + (tile_id % group_size_m)
-            pid_n = (tile_id % num_pid_in_group) // group_size_m
-
-            # swizzle m
-            if nnodes == 1:
-                alpha = 0
-                beta = 0
-                pid_m = (pid_m + ((((rank ^ alpha) + beta) % num_ranks) * pid_ms_per_rank)) % num_pid_m
-            else:
-                m_rank = pid_m // pid_ms_per_rank
-                pid_m_intra_rank = pid_m - m_rank * pid_ms_per_rank
-                m_node_id = m_rank // LOCAL_WORLD_SIZE
-                m_local_rank = m_rank % LOCAL_WORLD_SIZE
-                swizzle_m_node_id = (m_node_id + node_id) % nnodes
-                swizzle_m_local_rank = (m_local_rank + rank) % LOCAL_WORLD_SIZE
-                swizzle_m_rank = swizzle_m_node_id * LOCAL_WORLD_SIZE + swizzle_m_local_rank
-
-                pid_m = swizzle_m_rank * pid_ms_per_rank + pid_m_intra_rank
-
+    # bit r is set once this program has seen rank r ready
+    tl.static_assert(num_ranks <= 64)
+    ready_mask = tl.full([], 0, tl.int64)
+
+    if DYNAMIC_TILE_SCHEDULE:
+        # Work-stealing scheduler: each program pulls the next tile from a global queue, so programs stalled
+        # on a late rank do not hold back tiles whose data is already there.
+        # tile_counter_ptr[0] is the next tile id, tile_counter_ptr[1] counts the programs that have exited.
+        tile_id = tl.atomic_add(tile_counter_ptr, 1)
+        while tile_id < num_tiles:
+            pid_m, pid_n = _compute_pid_m_n(tile_id, num_pid_m, num_pid_n, pid_ms_per_rank, rank, num_ranks,
+                                            GROUP_SIZE_M, LOCAL_WORLD_SIZE, swizzle_lut_ptr, EVEN_GROUP_M)
             offs_am = pid_m * BLOCK_SIZE_M
             offs_bn = pid_n * BLOCK_SIZE_N
 
             rank_beg = offs_am // M_per_rank
             rank_end = (min(offs_am + BLOCK_SIZE_M, M) - 1) // M_per_rank
-            token = dl.wait(ready_ptr + rank_beg, rank_end - rank_beg + 1, "gpu", "acquire", waitValue=ready_value)
+            token, ready_mask = _wait_ranks_ready(ready_ptr, ready_mask, rank_beg, rank_end, ready_value)
             a_desc = dl.consume_token(a_desc, token)
 
-        # You can also put the barrier here with a minor performance drop
-        # if needs_wait:
-        #     num_barriers_to_wait = num_barriers_wait_per_block
-        #     token = dl.wait(ready_ptr + (ki * BLOCK_SIZE_K) // (K // num_ranks), num_barriers_to_wait, "gpu", "acquire")
-        #     a_desc = dl.consume_token(a_desc, token)
-
-        offs_k = ki * BLOCK_SIZE_K
-
-        a = a_desc.load([offs_am, offs_k])
-        b = b_desc.load([offs_bn, offs_k])
-        accumulator = tl.dot(a, b.T, accumulator)
+            # peel the first k tile so the accumulator never needs zero-filling
+            a, b = _load_ab_tiles(a_desc, b_desc, offs_am, offs_bn, 0, A_FP8)
+            accumulator = tl.dot(a, b)
+            for ki in tl.range(1, k_tiles, warp_specialize=WARP_SPECIALIZE):
+                offs_k = ki * BLOCK_SIZE_K
+                a, b = _load_ab_tiles(a_desc, b_desc, offs_am, offs_bn, offs_k, A_FP8)
+                accumulator = tl.dot(a, b, accumulator)
+
+            a_scale = _load_a_scale(a_scale_ptr, token, offs_am, M, BLOCK_SIZE_M) if A_FP8 else None
+            _store_c_tile(c_desc, accumulator, offs_am, offs_bn, dtype, BLOCK_SIZE_M, BLOCK_SIZE_N, EPILOGUE_SUBTILE,
+                          a_scale)
+            tile_id = tl.atomic_add(tile_counter_ptr, 1)
+
+        # the last program to exit resets the queue for the next launch
+        num_exited = tl.atomic_add(tile_counter_ptr + 1, 1)
+        if num_exited == num_programs - 1:
+            tl.store(tile_counter_ptr, 0)
+            tl.store(tile_counter_ptr + 1, 0)
+    else:
+        # with WARP_SPECIALIZE the compiler partitions the loop into TMA-load, MMA and epilogue warp groups
+        for tile_id in tl.range(start_pid, num_tiles, num_programs, flatten=True, warp_specialize=WARP_SPECIALIZE):
+            pid_m, pid_n = _compute_pid_m_n(tile_id, num_pid_m, num_pid_n, pid_ms_per_rank, rank, num_ranks,
+                                            GROUP_SIZE_M, LOCAL_WORLD_SIZE, swizzle_lut_ptr, EVEN_GROUP_M)
+            offs_am = pid_m * BLOCK_SIZE_M
+            offs_bn = pid_n * BLOCK_SIZE_N
 
-        if ki == k_tiles - 1:
-            if EPILOGUE_SUBTILE:
-                acc = tl.reshape(accumulator, (BLOCK_SIZE_M, 2, BLOCK_SIZE_N // 2))
-                acc = tl.permute(acc, (0, 2, 1))
-                acc0, acc1 = tl.split(acc)
-                c0 = acc0.to(dtype)
-                c_desc.store([offs_am, offs_bn], c0)
-                c1 = acc1.to(dtype)
-                c_desc.store([offs_am, offs_bn + BLOCK_SIZE_N // 2], c1)
-            else:
-                c = accumulator.to(dtype)
-                c_desc.store([offs_am, offs_bn], c)
+            rank_beg = offs_am // M_per_rank
+            rank_end = (min(offs_am + BLOCK_SIZE_M, M) - 1) // M_per_rank
+            token, ready_mask = _wait_ranks_ready(ready_ptr, ready_mask, rank_beg, rank_end, ready_value)
+            a_desc = dl.consume_token(a_desc, token)
 
-            accumulator = tl.zeros((BLOCK_SIZE_M, BLOCK_SIZE_N), dtype=tl.float32)
+            # peel the first k tile so the accumulator never needs zero-filling
+            a, b = _load_ab_tiles(a_desc, b_desc, offs_am, offs_bn, 0, A_FP8)
+            accumulator = tl.dot(a, b)
+            for ki in range(1, k_tiles):
+                # You can also put the barrier here with a minor performance drop
+                # if needs_wait:
+                #     num_barriers_to_wait = num_barriers_wait_per_block
+                #     token = dl.wait(ready_ptr + (ki * BLOCK_SIZE_K) // (K // num_ranks), num_barriers_to_wait, "gpu", "acquire")
+                #     a_desc = dl.consume_token(a_desc, token)
+                offs_k = ki * BLOCK_SIZE_K
+                a, b = _load_ab_tiles(a_desc, b_desc, offs_am, offs_bn, offs_k, A_FP8)
+                accumulator = tl.dot(a, b, accumulator)
+
+            a_scale = _load_a_scale(a_scale_ptr, token, offs_am, M, BLOCK_SIZE_M) if A_FP8 else None
+            _store_c_tile(c_desc, accumulator, offs_am, offs_bn, dtype, BLOCK_SIZE_M, BLOCK_SIZE_N, EPILOGUE_SUBTILE,
+                          a_scale)
+
+
+@triton.heuristics({"EVEN_GROUP_M": lambda args: _even_group_m(args["M"], args["BLOCK_SIZE_M"], args["GROUP_SIZE_M"])})
+@triton.jit(launch_metadata=_matmul_launch_metadata)
+def kernel_fused_ag_gemm_persistent(a_ptr, b_ptr, c_ptr,  #
+                                    M, N, K,  #
+                                    rank: tl.constexpr, num_ranks: tl.constexpr, ready_ptr,
+                                    BLOCK_SIZE_M: tl.constexpr,  #
+                                    BLOCK_SIZE_N: tl.constexpr,  #
+                                    BLOCK_SIZE_K: tl.constexpr,  #
+                                    GROUP_SIZE_M: tl.constexpr,  #
+                                    EPILOGUE_SUBTILE: tl.constexpr,  #
+                                    DISPATCH_BLOCK_NUM: tl.constexpr, SEND_BLOCK_NUM: tl.constexpr,
+                                    ready_value: tl.constexpr = 1, LOCAL_WORLD_SIZE: tl.constexpr = 8,
+                                    tile_counter_ptr=None, DYNAMIC_TILE_SCHEDULE: tl.constexpr = False,
+                                    swizzle_lut_ptr=None, EVEN_GROUP_M: tl.constexpr = False):  #
+    """ inter-node allgather and persistent GEMM in one launch. the first DISPATCH_BLOCK_NUM + SEND_BLOCK_NUM programs
+        push the local rows of A like `nvshmem_device_producer_all_gather_2d_put_block_kernel`, the other
+        programs run `kernel_consumer_gemm_persistent` on the ready flags the pushes raise. producers and consumers
+        spin on each other, so the grid must fit on the device at once.
+    """
+    pid = tl.program_id(axis=0)
+    NUM_AG_PROGRAMS: tl.constexpr = DISPATCH_BLOCK_NUM + SEND_BLOCK_NUM
+    if pid < NUM_AG_PROGRAMS:
+        M_per_rank = M // num_ranks
+        all_gather_2d_put_block(pid, a_ptr, ready_ptr, M_per_rank * K, a_ptr.dtype.element_ty.primitive_bitwidth // 8,
+                                ready_value, rank, LOCAL_WORLD_SIZE, num_ranks, DISPATCH_BLOCK_NUM, SEND_BLOCK_NUM)
+    else:
+        _consumer_gemm_persistent_tiles(pid - NUM_AG_PROGRAMS,
+                                        tl.num_programs(axis=0) - NUM_AG_PROGRAMS, a_ptr, b_ptr, c_ptr, M, N, K, rank,
+                                        num_ranks, ready_ptr, BLOCK_SIZE_M, BLOCK_SIZE_N, BLOCK_SIZE_K, GROUP_SIZE_M,
+                                        EPILOGUE_SUBTILE, ready_value, LOCAL_WORLD_SIZE, tile_counter_ptr,
+                                        DYNAMIC_TILE_SCHEDULE, False, None, False, swizzle_lut_ptr, EVEN_GROUP_M)
 
 
 def _kernel_consumer_gemm_non_persistent_repr(proxy):
@@ -283,8 +688,8 @@ def _kernel_consumer_gemm_non_persistent_repr(proxy):
     return f"triton3x_sm{cap_major}{cap_minor}_ag_gemm_tensorop_{a_dtype}_{b_dtype}_{c_dtype}_{BM}x{BN}x{BK}_{a_trans}{b_trans}{c_trans}"
 
 
-@triton.jit(do_not_specialize=["rank"], launch_metadata=_matmul_launch_metadata,
-            repr=_kernel_consumer_gemm_non_persistent_repr)
+@triton.heuristics({"EVEN_GROUP_M": lambda args: _even_group_m(args["M"], args["BLOCK_SIZE_M"], args["GROUP_SIZE_M"])})
+@triton.jit(launch_metadata=_matmul_launch_metadata, repr=_kernel_consumer_gemm_non_persistent_repr)
 def kernel_consumer_gemm_non_persistent(
         # Pointers to matrices
         a_ptr, b_ptr, c_ptr,
@@ -295,10 +700,10 @@ def kernel_consumer_gemm_non_persistent(
         # by to get the element one row down (A has M rows).
         stride_am, stride_ak,  #
         stride_bk, stride_bn,  #
-        stride_cm, stride_cn, rank, WORLD_SIZE: tl.constexpr, barrier_ptr,
+        stride_cm, stride_cn, rank: tl.constexpr, WORLD_SIZE: tl.constexpr, barrier_ptr,
         # Meta-parameters
         BLOCK_SIZE_M: tl.constexpr, BLOCK_SIZE_N: tl.constexpr, BLOCK_SIZE_K: tl.constexpr,  #
-        GROUP_SIZE_M: tl.constexpr,  #
+        GROUP_SIZE_M: tl.constexpr, EVEN_GROUP_M: tl.constexpr = False,  #
 ):
     """Kernel for computing the matmul C = A x B.
     A has shape (M, K), B has shape (K, N) and C has shape (M, N)
@@ -319,7 +724,10 @@ def kernel_consumer_gemm_non_persistent(
     num_pid_in_group = GROUP_SIZE_M * num_pid_n
     group_id = pid // num_pid_in_group
     first_pid_m = group_id * GROUP_SIZE_M
-    group_size_m = min(num_pid_m - first_pid_m, GROUP_SIZE_M)
+    if EVEN_GROUP_M:
+        group_size_m = GROUP_SIZE_M
+    else:
+        group_size_m = min(num_pid_m - first_pid_m, GROUP_SIZE_M)
     pid_m = first_pid_m + ((pid % num_pid_in_group) % group_size_m)
     pid_n = (pid % num_pid_in_group) // group_size_m
 
@@ -334,7 +742,7 @@ def kernel_consumer_gemm_non_persistent(
     offs_am = pid_m * BLOCK_SIZE_M
     rank_beg = offs_am // m_per_rank
     rank_end = (min(offs_am + BLOCK_SIZE_M, M) - 1) // m_per_rank
-    token = dl.wait(barrier_ptr + rank_beg, rank_end - rank_beg + 1, "gpu", "acquire", waitValue=1)
+    token = multi_flag_wait(barrier_ptr, rank_beg, rank_end, 1)
 
     # ----------------------------------------------------------
     # Create pointers for the first blocks of A and B.
@@ -393,9 +801,164 @@ def matmul_get_configs():
     ]
 
 
+def persistent_matmul_get_configs():
+    """ the persistent GEMM also tunes GROUP_SIZE_M and deeper/shallower pipelines: it runs with fewer programs than
+        tiles, so the tile order and the latency hiding per program matter more than for the one-tile-per-program GEMM.
+    """
+    return [
+        triton.Config({'BLOCK_SIZE_M': BM, 'BLOCK_SIZE_N': BN, "BLOCK_SIZE_K": BK, "GROUP_SIZE_M": G}, num_stages=s,
+                      num_warps=w)
+        for BM in [128]
+        for BN in [128, 256]
+        for BK in [64, 128]
+        for G in [1, 4, 8]
+        for s in [2, 3, 4]
+        for w in [4, 8]
+    ]
+
+
+@functools.lru_cache()
+def pick_config(M, N, K, dtype_bytes, num_sms, smem_bytes=None, b_dtype_bytes=None, capability=None):
+    """ analytic tiling for the consumer GEMM, used instead of autotune when the tiling is not given.
+
+    BLOCK_K is one 128B swizzle row, BLOCK_N is halved when the large tile can not fill the SMs in one wave,
+    and num_stages is as many A/B stages as fit in shared memory next to the epilogue buffer.
+    dtype_bytes is the element size of A, b_dtype_bytes that of B when it differs (fp8 A).
+    BLOCK_N=256 is kept for sm90+ wgmma, pre-Hopper mma tiles stay at 128x128 to avoid register spills.
+    """
+    if smem_bytes is None or capability is None:
+        device_index = torch.cuda.current_device()
+        props = torch.cuda.get_device_properties(device_index)
+        smem_bytes = smem_bytes or getattr(props, "shared_memory_per_block_optin", 227 * 1024)
+        capability = capability or torch.cuda.get_device_capability(device_index)
+    BLOCK_SIZE_M = 128
+    wide_n = capability[0] >= 9 and N > 128
+    BLOCK_SIZE_N = 256 if wide_n and triton.cdiv(M, BLOCK_SIZE_M) * triton.cdiv(N, 256) >= num_sms else 128
+    BLOCK_SIZE_K = 128 // dtype_bytes
+    b_dtype_bytes = b_dtype_bytes or dtype_bytes
+    stage_bytes = (BLOCK_SIZE_M * dtype_bytes + BLOCK_SIZE_N * b_dtype_bytes) * BLOCK_SIZE_K
+    epilogue_bytes = BLOCK_SIZE_M * (BLOCK_SIZE_N // 2) * 2  # subtiled 16-bit C tile
+    num_stages = max(2, min(5, (smem_bytes - epilogue_bytes) // stage_bytes))
+    return triton.Config(
+        {"BLOCK_SIZE_M": BLOCK_SIZE_M, "BLOCK_SIZE_N": BLOCK_SIZE_N, "BLOCK_SIZE_K": BLOCK_SIZE_K, "GROUP_SIZE_M": 8},
+        num_stages=num_stages, num_warps=8)
+
+
+_LAUNCH_OPTIONS = ("num_warps", "num_stages", "num_ctas")
+# compiled kernels kept per kernel_cache, the oldest is dropped first
+_KERNEL_CACHE_SIZE = 64
+
+
+def _launch_gemm_persistent_cached(kernel_cache, key, grid, *args, **kwargs):
+    """ launch `kernel_consumer_gemm_persistent` on a 3-tuple grid. the first launch for a key goes through the JIT
+        dispatcher, later ones call the cached compiled kernel directly, skipping argument specialization, cache key
+        hashing and heuristics. key must cover every value the kernel is specialized on (shapes, dtypes, constexprs,
+        launch options and tensor alignment). kernel_cache=None always dispatches.
+        only the argument order and the non-tensor values are cached, tensors always come from the current call.
+    """
+    if kernel_cache is None:
+        return kernel_consumer_gemm_persistent[grid](*args, **kwargs)
+    call_kwargs = {k: v for k, v in kwargs.items() if k not in _LAUNCH_OPTIONS}
+    cached = kernel_cache.get(key)
+    if cached is None:
+        compiled = kernel_consumer_gemm_persistent[grid](*args, **kwargs)
+        bound = kernel_consumer_gemm_persistent.fn.signature.bind(*args, **call_kwargs)
+        bound.apply_defaults()
+        arguments = dict(bound.arguments)
+        for name, heuristic in kernel_consumer_gemm_persistent.values.items():
+            arguments[name] = heuristic(arguments)
+        names = tuple(arguments)
+        fixed = {k: v for k, v in arguments.items() if not isinstance(v, torch.Tensor)}
+        if len(kernel_cache) >= _KERNEL_CACHE_SIZE:
+            kernel_cache.pop(next(iter(kernel_cache)))
+        kernel_cache[key] = (compiled, names, fixed)
+        return compiled
+    compiled, names, fixed = cached
+    # names is ordered as the kernel signature, positional args fill its head
+    arguments = dict(fixed)
+    arguments.update(zip(names, args))
+    arguments.update(call_kwargs)
+    compiled[grid](*(arguments[name] for name in names))
+    return compiled
+
+
+def _get_output_buffer(ctx, M, N, dtype, device, out=None):
+    """ C is out if given, else a fresh tensor. with cuda_graph the graph needs a fixed C, so C is a view of
+        ctx.c_buffer instead, allocated on first use, grown on demand and overwritten by the next call.
+    """
+    if out is not None:
+        assert out.shape == (M, N) and out.dtype == dtype, f"out must be a {dtype} tensor of shape {(M, N)}"
+        # the persistent kernels write C through a TMA descriptor with strides [N, 1]
+        assert out.is_contiguous() and out.data_ptr() % 16 == 0, "out must be contiguous and 16-byte aligned"
+        return out
+    if not ctx.cuda_graph:
+        return torch.empty([M, N], dtype=dtype, device=device)
+    if ctx.c_buffer is None or ctx.c_buffer.shape[0] < M or ctx.c_buffer.shape[1] != N or ctx.c_buffer.dtype != dtype:
+        ctx.c_buffer = torch.empty([M, N], dtype=dtype, device=device)
+    return ctx.c_buffer[:M]
+
+
+def _balanced_num_sms(num_tiles, max_num_sms):
+    """ fewest persistent programs that finish num_tiles in as many waves as max_num_sms programs would. every
+        program then gets the same number of tiles, and the SMs left over stay free for the allgather.
+    """
+    num_waves = triton.cdiv(num_tiles, max_num_sms)
+    return triton.cdiv(num_tiles, num_waves)
+
+
+def _resolve_tiling(BLOCK_M, BLOCK_N, BLOCK_K, stages, M, N, K, dtype_bytes, num_sms, b_dtype_bytes=None):
+    """ fill the tiling arguments left as None from `pick_config` """
+    if None not in (BLOCK_M, BLOCK_N, BLOCK_K, stages):
+        return BLOCK_M, BLOCK_N, BLOCK_K, stages
+    config = pick_config(M, N, K, dtype_bytes, num_sms, b_dtype_bytes=b_dtype_bytes)
+    BLOCK_M = BLOCK_M or config.kwargs["BLOCK_SIZE_M"]
+    BLOCK_N = BLOCK_N or config.kwargs["BLOCK_SIZE_N"]
+    BLOCK_K = BLOCK_K or config.kwargs["BLOCK_SIZE_K"]
+    stages = stages or config.num_stages
+    return BLOCK_M, BLOCK_N, BLOCK_K, stages
+
+
+@functools.lru_cache()
+def _inter_node_launch_plan(M, N, K, dtype_bytes, num_sms, num_ranks, local_world_size, copy_engine_dispatch, autotune,
+                            num_ctas, BLOCK_M, BLOCK_N, BLOCK_K, stages, b_dtype_bytes=None):
+    """ (num_ag_sms, num_gemm_sms, BLOCK_M, BLOCK_N, BLOCK_K, stages) of `ag_gemm_inter_node_persistent_op`. a pure
+        function of its arguments, so steady-state calls with the same shapes skip the arithmetic.
+    """
+    n_nodes = num_ranks // local_world_size
+    num_ag_sms = n_nodes - 1 if copy_engine_dispatch else (local_world_size + n_nodes - 2)
+    num_gemm_sms = num_sms - num_ag_sms
+    if not autotune:
+        # each persistent program is a cluster of num_ctas CTAs
+        num_gemm_sms = num_gemm_sms // num_ctas
+        BLOCK_M, BLOCK_N, BLOCK_K, stages = _resolve_tiling(BLOCK_M, BLOCK_N, BLOCK_K, stages, M, N, K, dtype_bytes,
+                                                            num_gemm_sms, b_dtype_bytes)
+        num_gemm_sms = _balanced_num_sms(triton.cdiv(M, BLOCK_M) * triton.cdiv(N, BLOCK_N), num_gemm_sms)
+    return num_ag_sms, num_gemm_sms, BLOCK_M, BLOCK_N, BLOCK_K, stages
+
+
+def _prune_persistent_configs(configs, named_args, **kwargs):
+    """ drop configs whose K tile of A is narrower than a 128B swizzle row, e.g. BLOCK_SIZE_K=64 with fp8 A,
+        and configs whose pipeline does not fit in shared memory, instead of compiling them to fail.
+    """
+    a_bytes = named_args["a_ptr"].element_size()
+    b_bytes = named_args["b_ptr"].element_size()
+    props = torch.cuda.get_device_properties(torch.cuda.current_device())
+    smem_bytes = getattr(props, "shared_memory_per_block_optin", 227 * 1024)
+
+    def fits(config):
+        BM, BN, BK = (config.kwargs[k] for k in ("BLOCK_SIZE_M", "BLOCK_SIZE_N", "BLOCK_SIZE_K"))
+        epilogue_bytes = BM * (BN // 2) * 2  # subtiled 16-bit C tile
+        return config.num_stages * (BM * a_bytes + BN * b_bytes) * BK + epilogue_bytes <= smem_bytes
+
+    return [config for config in configs if config.kwargs["BLOCK_SIZE_K"] * a_bytes >= 128 and fits(config)]
+
+
 # Use Triton's autotune to create a wrapper
-kernel_consumer_gemm_persistent_autotune = triton.autotune(configs=matmul_get_configs(),
-                                                           key=["M", "N", "K"])(kernel_consumer_gemm_persistent)
+# NUM_SMS is in the key so that a different GEMM/allgather SM split is tuned again.
+# results are kept in TRITON_CACHE_DIR, tuning runs once per shape and machine
+kernel_consumer_gemm_persistent_autotune = triton.autotune(
+    configs=persistent_matmul_get_configs(), key=["M", "N", "K", "NUM_SMS"], cache_results=True,
+    prune_configs_by={"early_config_prune": _prune_persistent_configs})(kernel_consumer_gemm_persistent)
 
 # Use Triton's autotune to create a wrapper
 kernel_consumer_gemm_non_persistent_autotune = triton.autotune(configs=matmul_get_configs(),
@@ -403,9 +966,10 @@ kernel_consumer_gemm_non_persistent_autotune = triton.autotune(configs=matmul_ge
 
 
 def ag_gemm_non_persistent_op(a, b, c, rank, num_local_ranks, num_ranks, workspace_tensors, barrier_tensors, comm_buf,
-                              for_correctness=False, ag_stream=None, gemm_stream=None, serial=False, BLOCK_M=128,
-                              BLOCK_N=256, BLOCK_K=64, stages=3, autotune=False,
-                              all_gather_method: AllGatherMethod = AllGatherMethod.All2All_IntraNode):
+                              for_correctness=False, ag_stream=None, gemm_stream=None, BLOCK_M=None, BLOCK_N=None,
+                              BLOCK_K=None, stages=None, autotune=False,
+                              all_gather_method: AllGatherMethod = AllGatherMethod.All2All_IntraNode, nccl_group=None,
+                              copy_engine_dispatch=False):
     """allgather gemm for intra-node
     Allgather global matrix A and do matmul with local matrix B, produces local matrix C
 
@@ -417,20 +981,23 @@ def ag_gemm_non_persistent_op(a, b, c, rank, num_local_ranks, num_ranks, workspa
         num_ranks (int): total number of ranks
         workspace_tensors (List[torch.Tensor<float>]): A list of symm-tensors used for inter-rank allgather.
             Each tensor shape: [maxM, K]. Created by `create_ag_gemm_intra_node_context`.
-        barrier_tensors (List[torch.Tensor<int32>]): A list of symm-tensors used for allgather.
+        barrier_tensors (List[torch.Tensor<uint64>]): A list of symm-tensors used for allgather.
             Each tensor shape: [num_ranks]. Created by `create_ag_gemm_intra_node_context`.
         comm_buf (torch.Tensor<int32>): A symm-tensor used for global synchronization.
             Shape: [MAX_NUM_BLOCKS_ON_GPU(65536)*num_ranks]. Created by `create_ag_gemm_intra_node_context`.
         for_correctness (bool, optional): if only for correctness, communication would sleep some seconds to
             trigger possible synchronization and dependency bugs. Defaults to False.
-        ag_stream (torch.cuda.streams.Stream, optional): The stream used for allgather, if not provided, create a new one. Defaults to None.
+        ag_stream (torch.cuda.streams.Stream, optional): The stream used for allgather, if not provided, use a per-device default stream. Defaults to None.
         gemm_stream (torch.cuda.streams.Stream, optional): The stream used for gemm, if not provided, use current stream. Defaults to None.
-        serial (bool, optional): Make the execution serialized, for debug. Defaults to False.
-        BLOCK_M (int, optional): GEMM tiling factor for M dim. Defaults to 128.
-        BLOCK_N (int, optional): GEMM tiling factor for N dim. Defaults to 256.
-        BLOCK_K (int, optional): GEMM tiling factor for K dim. Defaults to 64.
-        stages (int, optional): GEMM async-copy stages. Defaults to 3.
+        BLOCK_M (int, optional): GEMM tiling factor for M dim. Defaults to None, picked by `pick_config`.
+        BLOCK_N (int, optional): GEMM tiling factor for N dim. Defaults to None, picked by `pick_config`.
+        BLOCK_K (int, optional): GEMM tiling factor for K dim. Defaults to None, picked by `pick_config`.
+        stages (int, optional): GEMM async-copy stages. Defaults to None, picked by `pick_config`.
         autotune (bool, optional): whether to enable autotune. Defaults to False.
+        nccl_group (torch.distributed.ProcessGroup, optional): NCCL group of all ranks. if given, inter-node
+            allgather of at least `NCCL_MIN_NBYTES_PER_RANK` bytes per rank goes through NCCL. Defaults to None.
+        copy_engine_dispatch (bool, optional): intra-node only. push a into every slot with the copy engine,
+            after `reset_ready_and_barrier_all`, ignoring all_gather_method. Defaults to False.
 
     Returns:
         Triton compiled code: used for debug
@@ -441,18 +1008,25 @@ def ag_gemm_non_persistent_op(a, b, c, rank, num_local_ranks, num_ranks, workspa
 
     M_per_rank, K = a.shape
     M = M_per_rank * num_ranks
-    N_per_rank, K = b.shape
+    N_per_rank = b.shape[0]
 
-    ag_stream = torch.cuda.Stream() if ag_stream is None else ag_stream
+    ag_stream = _get_default_ag_stream(torch.cuda.current_device()) if ag_stream is None else ag_stream
     gemm_stream = torch.cuda.current_stream() if gemm_stream is None else gemm_stream
     current_stream = torch.cuda.current_stream()
-    ag_stream.wait_stream(current_stream)
-    gemm_stream.wait_stream(current_stream)
+    _fence(current_stream, ag_stream, gemm_stream)
 
-    grid = lambda META: (triton.cdiv(M, META["BLOCK_SIZE_M"]) * triton.cdiv(N_per_rank, META["BLOCK_SIZE_N"]), )
+    if not autotune:
+        BLOCK_M, BLOCK_N, BLOCK_K, stages = _resolve_tiling(BLOCK_M, BLOCK_N, BLOCK_K, stages, M, N_per_rank, K,
+                                                            a.element_size(), _sm_count(torch.cuda.current_device()))
+        grid = (triton.cdiv(M, BLOCK_M) * triton.cdiv(N_per_rank, BLOCK_N), )
+    else:
+        grid = lambda META: (triton.cdiv(M, META["BLOCK_SIZE_M"]) * triton.cdiv(N_per_rank, META["BLOCK_SIZE_N"]), )
 
     def call_ag():
-        if num_local_ranks == num_ranks:
+        if num_local_ranks == num_ranks and copy_engine_dispatch:
+            cp_engine_producer_all_gather_full_mesh_push(rank, num_ranks, a, workspace_tensors, barrier_tensors,
+                                                         ag_stream)
+        elif num_local_ranks == num_ranks:
             cp_engine_producer_all_gather_intra_node(
                 rank,
                 num_ranks,
@@ -477,14 +1051,10 @@ def ag_gemm_non_persistent_op(a, b, c, rank, num_local_ranks, num_ranks, workspa
                 True,  # TODO(houqi.1993)
                 all_gather_method=all_gather_method,
                 for_correctness=for_correctness,
+                nccl_group=nccl_group,
             )
 
-    if serial:
-        call_ag()
-        current_stream.wait_stream(ag_stream)
-        torch.cuda.synchronize()
-    else:
-        call_ag()
+    call_ag()
 
     local_rank = rank % num_local_ranks
     with torch.cuda.stream(gemm_stream):
@@ -521,15 +1091,17 @@ def ag_gemm_non_persistent_op(a, b, c, rank, num_local_ranks, num_ranks, workspa
                 c.stride(0), c.stride(1),  #
                 rank, num_ranks, barrier_tensors[local_rank])
 
-    current_stream.wait_stream(ag_stream)
-    current_stream.wait_stream(gemm_stream)
+    _fence(ag_stream, current_stream)
+    _fence(gemm_stream, current_stream)
 
     return compiled
 
 
 def ag_gemm_intra_node_persistent_op(a, b, c, rank, num_ranks, workspace_tensors, barrier_tensors, comm_buf,
-                                     for_correctness=False, ag_stream=None, gemm_stream=None, serial=False, BLOCK_M=128,
-                                     BLOCK_N=256, BLOCK_K=64, stages=3, autotune=False):
+                                     for_correctness=False, ag_stream=None, gemm_stream=None, BLOCK_M=None,
+                                     BLOCK_N=None, BLOCK_K=None, stages=None, autotune=False, warp_specialize=False,
+                                     num_ctas=1, fp8=False, scale_tensors=None, num_sms=None, slot_ready_buf=None,
+                                     copy_engine_dispatch=False, tile_counter=None, alloc_fn=None):
     """allgather gemm for intra-node
     Allgather global matrix A and do matmul with local matrix B, produces local matrix C
 
@@ -541,20 +1113,35 @@ def ag_gemm_intra_node_persistent_op(a, b, c, rank, num_ranks, workspace_tensors
         num_ranks (int): total number of ranks
         workspace_tensors (List[torch.Tensor<float>]): A list of symm-tensors used for inter-rank allgather.
             Each tensor shape: [maxM, K]. Created by `create_ag_gemm_intra_node_context`.
-        barrier_tensors (List[torch.Tensor<int32>]): A list of symm-tensors used for allgather.
+        barrier_tensors (List[torch.Tensor<uint64>]): A list of symm-tensors used for allgather.
             Each tensor shape: [num_ranks]. Created by `create_ag_gemm_intra_node_context`.
         comm_buf (torch.Tensor<int32>): A symm-tensor used for global synchronization.
             Shape: [MAX_NUM_BLOCKS_ON_GPU(65536)*num_ranks]. Created by `create_ag_gemm_intra_node_context`.
         for_correctness (bool, optional): if only for correctness, communication would sleep some seconds to
             trigger possible synchronization and dependency bugs. Defaults to False.
-        ag_stream (torch.cuda.streams.Stream, optional): The stream used for allgather, if not provided, create a new one. Defaults to None.
+        ag_stream (torch.cuda.streams.Stream, optional): The stream used for allgather, if not provided, use a per-device default stream. Defaults to None.
         gemm_stream (torch.cuda.streams.Stream, optional): The stream used for gemm, if not provided, use current stream. Defaults to None.
-        serial (bool, optional): Make the execution serialized, for debug. Defaults to False.
-        BLOCK_M (int, optional): GEMM tiling factor for M dim. Defaults to 128.
-        BLOCK_N (int, optional): GEMM tiling factor for N dim. Defaults to 256.
-        BLOCK_K (int, optional): GEMM tiling factor for K dim. Defaults to 64.
-        stages (int, optional): GEMM async-copy stages. Defaults to 3.
+        BLOCK_M (int, optional): GEMM tiling factor for M dim. Defaults to None, picked by `pick_config`.
+        BLOCK_N (int, optional): GEMM tiling factor for N dim. Defaults to None, picked by `pick_config`.
+        BLOCK_K (int, optional): GEMM tiling factor for K dim. Defaults to None, picked by `pick_config`.
+        stages (int, optional): GEMM async-copy stages. Defaults to None, picked by `pick_config`.
         autotune (bool, optional): whether to enable autotune. Defaults to False.
+        warp_specialize (bool, optional): whether to warp-specialize the GEMM main loop. Blackwell only. Defaults to False.
+        num_ctas (int, optional): CTAs per thread block cluster, sm90+ only. a cluster computes one BLOCK_M x BLOCK_N tile
+            and shares the B tile, so BLOCK_M is usually doubled with num_ctas=2. Ignored with autotune. Defaults to 1.
+        fp8 (bool, optional): whether workspace_tensors hold A as fp8 e4m3 with per-row scales in scale_tensors,
+            as staged by `local_quantize_fp8_and_barrier_all`. Defaults to False.
+        scale_tensors (List[torch.Tensor<float32>], optional): A list of symm-tensors of per-row A scales, required
+            with fp8. Each tensor shape: [maxM]. Created by `create_ag_gemm_intra_node_context`. Defaults to None.
+        num_sms (int, optional): SM count of the device. Defaults to None, queried by `_sm_count`.
+        slot_ready_buf (torch.Tensor<int32>, optional): per-source-rank flags raised by peers once their slot is
+            staged, required when the local copy was done with `notify_peers=True`. Defaults to None.
+        copy_engine_dispatch (bool, optional): push a into every slot with the copy engine instead of pulling the
+            staged slots, after `reset_ready_and_barrier_all`. not supported with fp8. Defaults to False.
+        tile_counter (torch.Tensor<int32>, optional): tile queue of the dynamic tile schedule (sm100+), shape [2],
+            zeroed. must not be shared with a launch that may overlap. Defaults to None, one per gemm stream.
+        alloc_fn (Callable, optional): allocator of the TMA descriptor scratch, passed to `triton.set_allocator`.
+            Defaults to None, a scratch per stream shared by all callers without a context.
 
     Returns:
         Triton compiled code: used for debug
@@ -562,31 +1149,44 @@ def ag_gemm_intra_node_persistent_op(a, b, c, rank, num_ranks, workspace_tensors
     # Check constraints.
     assert a.shape[1] == b.shape[1], "Incompatible dimensions"  # b is transposed
     assert a.dtype == b.dtype, "Incompatible dtypes"
+    assert not fp8 or scale_tensors is not None, "fp8 requires scale_tensors"
+    assert not (fp8 and copy_engine_dispatch), "fp8 slots are quantized locally and must be pulled"
 
     M_per_rank, K = a.shape
     M = M_per_rank * num_ranks
-    N_per_rank, K = b.shape
+    N_per_rank = b.shape[0]
 
-    ag_stream = torch.cuda.Stream() if ag_stream is None else ag_stream
+    ag_stream = _get_default_ag_stream(torch.cuda.current_device()) if ag_stream is None else ag_stream
     gemm_stream = torch.cuda.current_stream() if gemm_stream is None else gemm_stream
     current_stream = torch.cuda.current_stream()
-    ag_stream.wait_stream(current_stream)
-    gemm_stream.wait_stream(current_stream)
-
-    NUM_SMS = torch.cuda.get_device_properties("cuda").multi_processor_count
-
-    # TMA descriptors require a global memory allocation
-    def alloc_fn(size: int, alignment: int, stream: Optional[int]):
-        return torch.empty(size, device="cuda", dtype=torch.int8)
-
-    triton.set_allocator(alloc_fn)
-
-    grid = lambda META: (min(
-        NUM_SMS,
-        triton.cdiv(M, META["BLOCK_SIZE_M"]) * triton.cdiv(N_per_rank, META["BLOCK_SIZE_N"]),
-    ), )
+    _fence(current_stream, ag_stream, gemm_stream)
+
+    device_index = torch.cuda.current_device()
+    NUM_SMS = num_sms or _sm_count(device_index)
+    if not autotune:
+        # each persistent program is a cluster of num_ctas CTAs
+        NUM_SMS = NUM_SMS // num_ctas
+        BLOCK_M, BLOCK_N, BLOCK_K, stages = _resolve_tiling(BLOCK_M, BLOCK_N, BLOCK_K, stages, M, N_per_rank, K,
+                                                            workspace_tensors[rank].element_size(), NUM_SMS,
+                                                            b.element_size())
+    dynamic_tile_schedule = _use_dynamic_tile_schedule(device_index)
+    tile_counter = _resolve_tile_counter(tile_counter, dynamic_tile_schedule, device_index, gemm_stream)
+
+    triton.set_allocator(alloc_fn or _tma_alloc_fn)
+
+    if not autotune:
+        grid = (min(NUM_SMS, triton.cdiv(M, BLOCK_M) * triton.cdiv(N_per_rank, BLOCK_N)), )
+    else:
+        grid = lambda META: (min(
+            NUM_SMS,
+            triton.cdiv(M, META["BLOCK_SIZE_M"]) * triton.cdiv(N_per_rank, META["BLOCK_SIZE_N"]),
+        ), )
 
     def call_ag():
+        if copy_engine_dispatch:
+            cp_engine_producer_all_gather_full_mesh_push(rank, num_ranks, a, workspace_tensors, barrier_tensors,
+                                                         ag_stream)
+            return
         cp_engine_producer_all_gather_full_mesh_pull(
             rank,
             num_ranks,
@@ -595,14 +1195,11 @@ def ag_gemm_intra_node_persistent_op(a, b, c, rank, num_ranks, workspace_tensors
             barrier_tensors,
             ag_stream,
             for_correctness=for_correctness,
+            scale_buffers=scale_tensors if fp8 else None,
+            src_ready_buffer=slot_ready_buf,
         )
 
-    if serial:
-        call_ag()
-        current_stream.wait_stream(ag_stream)
-        torch.cuda.synchronize()
-    else:
-        call_ag()
+    call_ag()
     with torch.cuda.stream(gemm_stream):
         if not autotune:
             compiled = kernel_consumer_gemm_persistent[grid](
@@ -620,28 +1217,38 @@ def ag_gemm_intra_node_persistent_op(a, b, c, rank, num_ranks, workspace_tensors
                 BLOCK_N,
                 BLOCK_K,
                 8,
-                False,
+                True,  # EPILOGUE_SUBTILE
                 NUM_SMS=NUM_SMS,  #
+                LOCAL_WORLD_SIZE=num_ranks,  # all ranks are on this node
+                tile_counter_ptr=tile_counter,
+                DYNAMIC_TILE_SCHEDULE=dynamic_tile_schedule,
+                WARP_SPECIALIZE=warp_specialize,
+                a_scale_ptr=scale_tensors[rank] if fp8 else None,
+                A_FP8=fp8,
                 num_stages=stages,
                 num_warps=8,
+                num_ctas=num_ctas,
             )
         else:
             compiled = kernel_consumer_gemm_persistent_autotune[grid](
                 workspace_tensors[rank][:M], b, c,  #
                 M, N_per_rank, K,  #
-                rank, num_ranks, barrier_tensors[rank], comm_buf, EPILOGUE_SUBTILE=False, NUM_SMS=NUM_SMS,  #
-            )
+                rank, num_ranks, barrier_tensors[rank], comm_buf, EPILOGUE_SUBTILE=True, NUM_SMS=NUM_SMS,  #
+                LOCAL_WORLD_SIZE=num_ranks, tile_counter_ptr=tile_counter, DYNAMIC_TILE_SCHEDULE=dynamic_tile_schedule,
+                WARP_SPECIALIZE=warp_specialize, a_scale_ptr=scale_tensors[rank] if fp8 else None, A_FP8=fp8)
 
-    current_stream.wait_stream(ag_stream)
-    current_stream.wait_stream(gemm_stream)
+    _fence(ag_stream, current_stream)
+    _fence(gemm_stream, current_stream)
 
     return compiled
 
 
 def ag_gemm_inter_node_persistent_op(a, b, c, rank, num_ranks, workspace_tensors, barrier_tensors, comm_buf,
-                                     ag_stream=None, internode_ag_stream=None, gemm_stream=None, BLOCK_M=128,
-                                     BLOCK_N=256, BLOCK_K=64, stages=3, local_world_size=8, signal_target=1,
-                                     autotune=None, copy_engine_dispatch=False):
+                                     ag_stream=None, internode_ag_stream=None, gemm_stream=None, BLOCK_M=None,
+                                     BLOCK_N=None, BLOCK_K=None, stages=None, local_world_size=8, signal_target=1,
+                                     autotune=None, copy_engine_dispatch=False, warp_specialize=False, num_ctas=1,
+                                     nccl_group=None, num_sms=None, kernel_cache=None, fuse_allgather=False, fp8=False,
+                                     scale_tensors=None, tile_counter=None, alloc_fn=None):
     """allgather gemm for inter-node
     Allgather global matrix A and do matmul with local matrix B, produces local matrix C
 
@@ -653,61 +1260,104 @@ def ag_gemm_inter_node_persistent_op(a, b, c, rank, num_ranks, workspace_tensors
         num_ranks (int): total number of ranks
         workspace_tensors (List[torch.Tensor<float>]): A list of symm-tensors used for inter-rank allgather.
             Each tensor shape: [maxM, K]. Created by `create_ag_gemm_intra_node_context`.
-        barrier_tensors (List[torch.Tensor<int32>]): A list of symm-tensors used for allgather.
+        barrier_tensors (List[torch.Tensor<uint64>]): A list of symm-tensors used for allgather.
             Each tensor shape: [num_ranks]. Created by `create_ag_gemm_intra_node_context`.
         comm_buf (torch.Tensor<int32>): A symm-tensor used for global synchronization.
             Shape: [MAX_NUM_BLOCKS_ON_GPU(65536)*num_ranks]. Created by `create_ag_gemm_intra_node_context`.
         for_correctness (bool, optional): if only for correctness, communication would sleep some seconds to
             trigger possible synchronization and dependency bugs. Defaults to False.
-        ag_stream (torch.cuda.streams.Stream, optional): The stream used for allgather, if not provided, create a new one. Defaults to None.
+        ag_stream (torch.cuda.streams.Stream, optional): The stream used for allgather, if not provided, use a per-device default stream. Defaults to None.
         gemm_stream (torch.cuda.streams.Stream, optional): The stream used for gemm, if not provided, use current stream. Defaults to None.
-        serial (bool, optional): Make the execution serialized, for debug. Defaults to False.
-        BLOCK_M (int, optional): GEMM tiling factor for M dim. Defaults to 128.
-        BLOCK_N (int, optional): GEMM tiling factor for N dim. Defaults to 256.
-        BLOCK_K (int, optional): GEMM tiling factor for K dim. Defaults to 64.
-        stages (int, optional): GEMM async-copy stages. Defaults to 3.
+        BLOCK_M (int, optional): GEMM tiling factor for M dim. Defaults to None, picked by `pick_config`.
+        BLOCK_N (int, optional): GEMM tiling factor for N dim. Defaults to None, picked by `pick_config`.
+        BLOCK_K (int, optional): GEMM tiling factor for K dim. Defaults to None, picked by `pick_config`.
+        stages (int, optional): GEMM async-copy stages. Defaults to None, picked by `pick_config`.
         autotune (bool, optional): whether to enable autotune. Defaults to False.
         copy_engine_dispatch (bool, optional): whether to use copy enginer for intra-node dispatch. Defaults to True.
+        warp_specialize (bool, optional): whether to warp-specialize the GEMM main loop. Blackwell only. Defaults to False.
+        num_ctas (int, optional): CTAs per thread block cluster, sm90+ only. a cluster computes one BLOCK_M x BLOCK_N tile
+            and shares the B tile, so BLOCK_M is usually doubled with num_ctas=2. Ignored with autotune. Defaults to 1.
+        nccl_group (torch.distributed.ProcessGroup, optional): NCCL group of all ranks. if given, allgather of at
+            least `NCCL_MIN_NBYTES_PER_RANK` bytes per rank goes through NCCL. Defaults to None.
+        num_sms (int, optional): SM count of the device. Defaults to None, queried by `_sm_count`.
+        kernel_cache (dict, optional): compiled GEMM kernels of previous calls, used without autotune.
+            Defaults to None, always dispatched through the JIT.
+        fuse_allgather (bool, optional): whether to run the allgather and the GEMM as one `kernel_fused_ag_gemm_persistent`
+            launch on the current stream, with no stream fork or join. Needs the SM-based allgather, without
+            copy_engine_dispatch, autotune, warp_specialize, num_ctas > 1 or nccl_group. Defaults to False.
+        fp8 (bool, optional): whether workspace_tensors hold A as fp8 e4m3 with per-row scales in scale_tensors,
+            as staged by `local_quantize_fp8_and_barrier_all` with is_internode=True. only the fp8 rows are
+            allgathered, the scales are already in place. Defaults to False.
+        scale_tensors (List[torch.Tensor<float32>], optional): A list of symm-tensors of per-row A scales, required
+            with fp8. Each tensor shape: [maxM]. Created by `create_ag_gemm_inter_node_context`. Defaults to None.
+        tile_counter (torch.Tensor<int32>, optional): tile queue of the dynamic tile schedule (sm100+), shape [2],
+            zeroed. must not be shared with a launch that may overlap. Defaults to None, one per gemm stream.
+        alloc_fn (Callable, optional): allocator of the TMA descriptor scratch, passed to `triton.set_allocator`.
+            Defaults to None, a scratch per stream shared by all callers without a context.
 
     Returns:
         Triton compiled code: used for debug
     """
     assert a.shape[1] == b.shape[1], "Incompatible dimensions"
     assert a.dtype == b.dtype, "Incompatible dtypes"
+    assert not fp8 or scale_tensors is not None, "fp8 requires scale_tensors"
+    assert not (fp8 and (fuse_allgather or nccl_group is not None)), "fp8 only supports the unfused nvshmem allgather"
 
     M_per_rank, K = a.shape
     M = M_per_rank * num_ranks
-    N_per_rank, K = b.shape
+    N_per_rank = b.shape[0]
 
     local_rank = rank % local_world_size
     n_nodes = num_ranks // local_world_size
-    num_ag_sms = n_nodes - 1 if copy_engine_dispatch else (local_world_size + n_nodes - 2)
-    num_gemm_sms = torch.cuda.get_device_properties("cuda").multi_processor_count - num_ag_sms
-
-    ag_stream = torch.cuda.Stream() if ag_stream is None else ag_stream
+    device_index = torch.cuda.current_device()
+    ag_buffer = workspace_tensors[local_rank][:M]
+    num_ag_sms, num_gemm_sms, BLOCK_M, BLOCK_N, BLOCK_K, stages = _inter_node_launch_plan(
+        M, N_per_rank, K, ag_buffer.element_size(), num_sms or _sm_count(device_index), num_ranks, local_world_size,
+        copy_engine_dispatch, bool(autotune), num_ctas, BLOCK_M, BLOCK_N, BLOCK_K, stages, b.element_size())
+    a_scale = scale_tensors[local_rank] if fp8 else None
+    dynamic_tile_schedule = _use_dynamic_tile_schedule(device_index)
+    # the fused kernel runs on the current stream
+    tile_stream = gemm_stream if gemm_stream is not None and not fuse_allgather else torch.cuda.current_stream()
+    tile_counter = _resolve_tile_counter(tile_counter, dynamic_tile_schedule, device_index, tile_stream)
+    swizzle_lut = _get_swizzle_rank_lut(rank, num_ranks, local_world_size, device_index)
+
+    if fuse_allgather:
+        assert not (copy_engine_dispatch or autotune or warp_specialize or num_ctas > 1 or nccl_group is not None), \
+            "fuse_allgather only supports the SM-based allgather and the plain persistent GEMM"
+        triton.set_allocator(alloc_fn or _tma_alloc_fn)
+        num_gemm_programs = min(num_gemm_sms, triton.cdiv(M, BLOCK_M) * triton.cdiv(N_per_rank, BLOCK_N))
+        return kernel_fused_ag_gemm_persistent[(num_ag_sms + num_gemm_programs, 1, 1)](
+            ag_buffer, b, c,  #
+            M, N_per_rank, K,  #
+            rank, num_ranks, barrier_tensors[local_rank], BLOCK_M, BLOCK_N, BLOCK_K, 8, True,  # EPILOGUE_SUBTILE
+            DISPATCH_BLOCK_NUM=local_world_size - 1, SEND_BLOCK_NUM=n_nodes - 1, ready_value=signal_target,
+            LOCAL_WORLD_SIZE=local_world_size, tile_counter_ptr=tile_counter,
+            DYNAMIC_TILE_SCHEDULE=dynamic_tile_schedule, swizzle_lut_ptr=swizzle_lut, num_stages=stages, num_warps=8)
+
+    ag_stream = _get_default_ag_stream(torch.cuda.current_device()) if ag_stream is None else ag_stream
     gemm_stream = torch.cuda.current_stream() if gemm_stream is None else gemm_stream
     current_stream = torch.cuda.current_stream()
-    ag_stream.wait_stream(current_stream)
-    gemm_stream.wait_stream(current_stream)
+    _fence(current_stream, ag_stream, gemm_stream, *([internode_ag_stream] if internode_ag_stream else []))
 
-    inter_node_allgather(a, workspace_tensors, barrier_tensors, signal_target, rank, local_world_size, num_ranks,
-                         ag_stream, internode_ag_stream, copy_engine_dispatch)
+    # the allgather moves the staged slot, whose dtype is the payload dtype
+    local_slot = ag_buffer[rank * M_per_rank:(rank + 1) * M_per_rank]
+    inter_node_allgather(local_slot, workspace_tensors, barrier_tensors, signal_target, rank, local_world_size,
+                         num_ranks, ag_stream, internode_ag_stream, copy_engine_dispatch, nccl_group=nccl_group)
 
     compiled = None
     with torch.cuda.stream(gemm_stream):
+        triton.set_allocator(alloc_fn or _tma_alloc_fn)
 
-        def alloc_fn(size: int, alignment: int, stream: Optional[int]):
-            return torch.empty(size, device="cuda", dtype=torch.int8)
-
-        triton.set_allocator(alloc_fn)
-
-        grid = lambda META: (min(
-            num_gemm_sms,
-            triton.cdiv(M, META["BLOCK_SIZE_M"]) * triton.cdiv(N_per_rank, META["BLOCK_SIZE_N"]),
-        ), )
         if not autotune:
-            compiled = kernel_consumer_gemm_persistent[grid](
-                workspace_tensors[local_rank][:M],
+            gemm_grid = (min(num_gemm_sms, triton.cdiv(M, BLOCK_M) * triton.cdiv(N_per_rank, BLOCK_N)), 1, 1)
+            key = ("ag_gemm_inter_node", M, N_per_rank, K, a.dtype, rank, num_ranks, local_world_size, signal_target,
+                   BLOCK_M, BLOCK_N, BLOCK_K, stages, num_ctas, warp_specialize, dynamic_tile_schedule, fp8,
+                   b.data_ptr() % 16 == 0)
+            compiled = _launch_gemm_persistent_cached(
+                kernel_cache,
+                key,
+                gemm_grid,
+                ag_buffer,
                 b,
                 c,  #
                 M,
@@ -721,27 +1371,41 @@ def ag_gemm_inter_node_persistent_op(a, b, c, rank, num_ranks, workspace_tensors
                 BLOCK_N,
                 BLOCK_K,
                 8,
-                False,
+                True,  # EPILOGUE_SUBTILE
                 NUM_SMS=num_gemm_sms,
                 ready_value=signal_target,
+                LOCAL_WORLD_SIZE=local_world_size,
+                tile_counter_ptr=tile_counter,
+                DYNAMIC_TILE_SCHEDULE=dynamic_tile_schedule,
+                WARP_SPECIALIZE=warp_specialize,
+                a_scale_ptr=a_scale,
+                A_FP8=fp8,
+                swizzle_lut_ptr=swizzle_lut,
                 num_stages=stages,
                 num_warps=8,
+                num_ctas=num_ctas,
             )
         else:
+            grid = lambda META: (min(
+                num_gemm_sms,
+                triton.cdiv(M, META["BLOCK_SIZE_M"]) * triton.cdiv(N_per_rank, META["BLOCK_SIZE_N"]),
+            ), )
             compiled = kernel_consumer_gemm_persistent_autotune[grid](
-                workspace_tensors[local_rank][:M], b, c,  #
+                ag_buffer, b, c,  #
                 M, N_per_rank, K,  #
-                rank, num_ranks, barrier_tensors[local_rank], comm_buf, EPILOGUE_SUBTILE=False, NUM_SMS=num_gemm_sms,
-                ready_value=signal_target  #
+                rank, num_ranks, barrier_tensors[local_rank], comm_buf, EPILOGUE_SUBTILE=True, NUM_SMS=num_gemm_sms,
+                ready_value=signal_target, LOCAL_WORLD_SIZE=local_world_size, tile_counter_ptr=tile_counter,
+                DYNAMIC_TILE_SCHEDULE=dynamic_tile_schedule, WARP_SPECIALIZE=warp_specialize, a_scale_ptr=a_scale,
+                A_FP8=fp8, swizzle_lut_ptr=swizzle_lut  #
             )
 
-    current_stream.wait_stream(ag_stream)
-    current_stream.wait_stream(gemm_stream)
+    _fence(ag_stream, current_stream)
+    _fence(gemm_stream, current_stream)
 
     return compiled
 
 
-@dataclass
+@dataclass(slots=True)
 class AllGatherGEMMTensorParallelContext:
     rank: int
     num_ranks: int
@@ -761,19 +1425,59 @@ class AllGatherGEMMTensorParallelContext:
     BLOCK_K: int = 64
     stages: int = 3
     autotune: bool = False
-    phase: int = 1
+    phase_device: Optional[torch.Tensor] = None
     all_gather_method: AllGatherMethod = AllGatherMethod.Auto
-
-    def update(self, rank, num_ranks, num_local_ranks=8, BLOCK_M=128, BLOCK_N=256, BLOCK_K=64, stages=3,
+    warp_specialize: bool = False
+    num_ctas: int = 1
+    fp8: bool = False
+    scale_tensors: Optional[List[torch.Tensor]] = None
+    nccl_group: Optional[torch.distributed.ProcessGroup] = None
+    num_sms: Optional[int] = None
+    c_buffer: Optional[torch.Tensor] = None
+    kernel_cache: dict = field(default_factory=dict)
+    copy_engine_dispatch: bool = False
+    ready_event: Optional[torch.cuda.Event] = None
+    cuda_graph: bool = False
+    graph: Optional[torch.cuda.CUDAGraph] = None
+    graph_key: Optional[tuple] = None
+    fuse_allgather: bool = False
+    tile_counter: Optional[torch.Tensor] = None
+    tma_scratch: dict = field(default_factory=dict)
+    retired_tma_scratch: list = field(default_factory=list)
+
+    def tma_alloc_fn(self, size: int, alignment: int, stream: Optional[int]):
+        """ TMA descriptor scratch of this context. while a captured graph may still write descriptors into a
+            scratch that is outgrown, the old one is kept alive until the graph is dropped.
+        """
+        return _grow_scratch(self.tma_scratch, size, stream,
+                             self.retired_tma_scratch if self.graph is not None else None)
+
+    def drop_graph(self):
+        """ release the captured graph and the scratch only it still used """
+        self.graph = None
+        self.retired_tma_scratch.clear()
+
+    def update(self, rank, num_ranks, num_local_ranks=8, BLOCK_M=None, BLOCK_N=None, BLOCK_K=None, stages=None,
                for_correctness=False, ag_stream=None, internode_ag_stream=None, gemm_stream=None, serial=False,
-               autotune=False):
+               autotune=False, N_per_rank=None):
+        """ tiling arguments left as None are picked by `pick_config` for the workspace shape and N_per_rank,
+            or keep their current value without N_per_rank.
+        """
         self.rank = rank
         self.num_ranks = num_ranks
         self.num_local_ranks = num_local_ranks
-        self.BLOCK_M = BLOCK_M
-        self.BLOCK_N = BLOCK_N
-        self.BLOCK_K = BLOCK_K
-        self.stages = stages
+        if N_per_rank is not None:
+            workspace = self.workspace_tensors[self.local_rank]
+            # with fp8 only A is staged as fp8, B keeps its 16-bit dtype
+            BLOCK_M, BLOCK_N, BLOCK_K, stages = _resolve_tiling(BLOCK_M, BLOCK_N, BLOCK_K, stages,
+                                                                workspace.shape[0], N_per_rank, workspace.shape[1],
+                                                                workspace.element_size(), self.num_sms
+                                                                or _sm_count(torch.cuda.current_device()),
+                                                                2 if self.fp8 else None)
+        self.BLOCK_M = BLOCK_M or self.BLOCK_M
+        self.BLOCK_N = BLOCK_N or self.BLOCK_N
+        self.BLOCK_K = BLOCK_K or self.BLOCK_K
+        self.stages = stages or self.stages
         self.for_correctness = for_correctness
         self.ag_stream = ag_stream
         self.internode_ag_stream = internode_ag_stream
@@ -782,9 +1486,55 @@ class AllGatherGEMMTensorParallelContext:
         self.autotune = autotune
 
 
-def create_ag_gemm_intra_node_context(tensor_A, tensor_B, rank, num_ranks, max_M=2**14, max_blocks=65536, BLOCK_M=128,
-                                      BLOCK_N=256, BLOCK_K=64, stages=3, for_correctness=False, ag_stream=None,
-                                      gemm_stream=None, serial=False, autotune=False):
+@triton.jit
+def init_context_buffers_kernel(comm_buf_ptr, barrier_ptr, phase_ptr, num_ranks, BLOCK_SIZE: tl.constexpr):
+    """ one launch instead of a fill per buffer: zero comm_buf[3 * num_ranks], the local ready flags and the phase
+        counter.
+    """
+    offs = tl.arange(0, BLOCK_SIZE)
+    tl.store(comm_buf_ptr + offs, 0, mask=offs < 3 * num_ranks)
+    tl.store(barrier_ptr + offs, 0, mask=offs < num_ranks)
+    tl.store(phase_ptr, 0)
+
+
+def _wait_context_ready(ctx: AllGatherGEMMTensorParallelContext):
+    """ the context is initialized on the stream that created it, the first call waits for that on its own stream """
+    if ctx.ready_event is not None:
+        torch.cuda.current_stream().wait_event(ctx.ready_event)
+        ctx.ready_event = None
+
+
+def _prepare_launch(a, b, ctx: AllGatherGEMMTensorParallelContext, gather: bool = False, out=None):
+    """ preamble shared by the ag_gemm_* and gemm_* entry points: wait for the context init, then pick C.
+        with gather, a is the local slice and C has num_ranks times its rows. returns (M, N, K, C, NUM_SMS).
+    """
+    _wait_context_ready(ctx)
+    M, K = a.shape
+    N = b.shape[0]
+    if gather:
+        M = ctx.num_ranks * M
+    C = _get_output_buffer(ctx, M, N, a.dtype, a.device, out)
+    return M, N, K, C, ctx.num_sms or _sm_count(torch.cuda.current_device())
+
+
+def _create_workspace_and_barrier_intra_node(max_M, K, dtype, num_ranks, alignment=128):
+    """ allocate the A workspace and the ready flags of every local rank in one symmetric buffer, flags placed
+        right after the A rows. one allocation keeps a single IPC handle per peer.
+    """
+    workspace_bytes = max_M * K * dtype.itemsize
+    barrier_offset = triton.cdiv(workspace_bytes, alignment) * alignment
+    # flags padded to whole 16B chunks, which `multi_flag_wait` reads
+    buffers = pynvshmem.nvshmem_create_tensor_list_intra_node([barrier_offset + triton.cdiv(num_ranks, 2) * 16],
+                                                              torch.int8)
+    workspaces = [buf[:workspace_bytes].view(dtype).view(max_M, K) for buf in buffers]
+    barriers = [buf[barrier_offset:barrier_offset + num_ranks * 8].view(torch.uint64) for buf in buffers]
+    return workspaces, barriers
+
+
+def create_ag_gemm_intra_node_context(tensor_A, tensor_B, rank, num_ranks, max_M=2**14, max_blocks=65536, BLOCK_M=None,
+                                      BLOCK_N=None, BLOCK_K=None, stages=None, for_correctness=False, ag_stream=None,
+                                      gemm_stream=None, serial=False, autotune=False, warp_specialize=False, num_ctas=1,
+                                      fp8=False, copy_engine_dispatch=False, cuda_graph=False):
     """create context for allgather gemm intra-node
 
     Args:
@@ -794,46 +1544,69 @@ def create_ag_gemm_intra_node_context(tensor_A, tensor_B, rank, num_ranks, max_M
         num_ranks (int): total number of ranks
         max_M: max number of M shape
         max_blocks: max number of blocks on GPU
-        BLOCK_M (int, optional): GEMM tiling factor for M dim. Defaults to 128.
-        BLOCK_N (int, optional): GEMM tiling factor for N dim. Defaults to 256.
-        BLOCK_K (int, optional): GEMM tiling factor for K dim. Defaults to 64.
-        stages (int, optional): GEMM async-copy stages. Defaults to 3.
+        BLOCK_M (int, optional): GEMM tiling factor for M dim. Defaults to None, picked by `pick_config`
+            for the device and the shapes of tensor_A and tensor_B.
+        BLOCK_N (int, optional): GEMM tiling factor for N dim. Defaults to None, picked by `pick_config`.
+        BLOCK_K (int, optional): GEMM tiling factor for K dim. Defaults to None, picked by `pick_config`.
+        stages (int, optional): GEMM async-copy stages. Defaults to None, picked by `pick_config`.
         for_correctness (bool, optional): if only for correctness, communication would sleep some seconds to
             trigger possible synchronization and dependency bugs. Defaults to False.
         ag_stream (torch.cuda.streams.Stream, optional): The stream used for allgather, if not provided, create a new one. Defaults to None.
         gemm_stream (torch.cuda.streams.Stream, optional): The stream used for gemm, if not provided, use current stream. Defaults to None.
         serial (bool, optional): Make the execution serialized, for debug. Defaults to False.
         autotune (bool, optional): whether to enable autotune. Defaults to False.
+        warp_specialize (bool, optional): whether to warp-specialize the persistent GEMM main loop. Blackwell only. Defaults to False.
+        num_ctas (int, optional): CTAs per thread block cluster of the persistent GEMM, sm90+ only. Defaults to 1.
+        fp8 (bool, optional): whether to allgather A as fp8 e4m3 with per-row scales, halving the allgather bytes.
+            persistent GEMM only. Defaults to False.
+        copy_engine_dispatch (bool, optional): whether to push A into the peer workspaces with the copy engine,
+            skipping the local staging copy and any SM-based allgather. Not supported with fp8. Defaults to False.
+        cuda_graph (bool, optional): whether `ag_gemm_intra_node` replays a CUDA graph of the whole call. the graph
+            is captured on the second call with the same a, b and output buffer and captured again when any of them
+            changes, so it pays off with static input buffers. Defaults to False.
 
     Returns:
         AllGatherGEMMTensorParallelContext
     """
+    assert not (fp8 and copy_engine_dispatch), "copy_engine_dispatch is not supported with fp8"
     M_per_rank, K = tensor_A.shape
     assert tensor_B.shape[
         1] == K, f"tensor_B should has shape (col_major) [N_per_rank, {K}], but get [{tensor_B.shape}]"
     assert tensor_A.dtype == tensor_B.dtype
-    dtype = tensor_A.dtype
-    fake_barrier = torch.ones([num_ranks], dtype=torch.int32, device=tensor_A.device)
-    workspaces = pynvshmem.nvshmem_create_tensor_list_intra_node([max_M, K], dtype)
-    barriers = pynvshmem.nvshmem_create_tensor_list_intra_node([num_ranks], torch.int32)
+    dtype = torch.float8_e4m3fn if fp8 else tensor_A.dtype
+    num_sms = _sm_count(torch.cuda.current_device())
+    BLOCK_M, BLOCK_N, BLOCK_K, stages = _resolve_tiling(BLOCK_M, BLOCK_N, BLOCK_K, stages, M_per_rank * num_ranks,
+                                                        tensor_B.shape[0], K, dtype.itemsize, num_sms,
+                                                        tensor_B.element_size())
+    fake_barrier = _get_fake_barrier(num_ranks, torch.cuda.current_device())
+    workspaces, barriers = _create_workspace_and_barrier_intra_node(max_M, K, dtype, num_ranks)
+    scales = pynvshmem.nvshmem_create_tensor_list_intra_node([max_M], torch.float32) if fp8 else None
     comm_buf = pynvshmem.nvshmem_create_tensor([3 * num_ranks], torch.int32)
-    comm_buf.fill_(0)
-    barriers[rank].fill_(0)
+    phase_device = torch.empty([1], dtype=torch.int32, device=tensor_A.device)
+    init_context_buffers_kernel[(1, )](comm_buf, barriers[rank], phase_device, num_ranks,
+                                       BLOCK_SIZE=triton.next_power_of_2(3 * num_ranks))
+    tile_counter = _create_tile_counter(tensor_A.device)
     current_stream = torch.cuda.current_stream()
     pynvshmem.nvshmemx_barrier_all_on_stream(current_stream.cuda_stream)
-    torch.cuda.synchronize()
+    # no device sync: work on this stream is ordered after the init, other streams wait on ready_event once
+    ready_event = torch.cuda.Event()
+    ready_event.record(current_stream)
 
     ret = AllGatherGEMMTensorParallelContext(
         rank=rank, num_ranks=num_ranks, local_rank=rank, num_local_ranks=num_ranks, workspace_tensors=workspaces,
         barrier_tensors=barriers, fake_barrier_tensor=fake_barrier, comm_buf=comm_buf, for_correctness=for_correctness,
-        ag_stream=ag_stream, gemm_stream=gemm_stream, serial=serial, BLOCK_M=BLOCK_M, BLOCK_N=BLOCK_N, BLOCK_K=BLOCK_K,
-        stages=stages, autotune=autotune, all_gather_method=get_auto_all_gather_method(num_ranks, num_ranks))
+        ag_stream=ag_stream if ag_stream is not None else torch.cuda.Stream(), gemm_stream=gemm_stream, serial=serial,
+        BLOCK_M=BLOCK_M, BLOCK_N=BLOCK_N, BLOCK_K=BLOCK_K, stages=stages, autotune=autotune,
+        all_gather_method=get_auto_all_gather_method(num_ranks, num_ranks), warp_specialize=warp_specialize,
+        num_ctas=num_ctas, fp8=fp8, scale_tensors=scales, num_sms=num_sms, phase_device=phase_device,
+        copy_engine_dispatch=copy_engine_dispatch, ready_event=ready_event, cuda_graph=cuda_graph,
+        tile_counter=tile_counter)
 
     return ret
 
 
-def ag_gemm_intra_node(a, b, ctx: AllGatherGEMMTensorParallelContext = None, rank=None, num_ranks=None,
-                       persistent=True):
+def ag_gemm_intra_node(a, b, ctx: AllGatherGEMMTensorParallelContext = None, rank=None, num_ranks=None, persistent=True,
+                       out=None):
     """allgather gemm for intra-node
     Allgather global matrix A and do matmul with local matrix B, produces local matrix C
 
@@ -841,16 +1614,48 @@ def ag_gemm_intra_node(a, b, ctx: AllGatherGEMMTensorParallelContext = None, ran
         a (torch.Tensor<float>): local matmul A matrix. shape: [M_per_rank, K]
         b (torch.Tensor<float>): local matmul B matrix. shape: [N_per_rank, K]
         ctx: (Optional[AllGatherGEMMTensorParallelContext]): if not provided, created immediately
+        out (Optional[torch.Tensor<float>]): written with C if provided. shape: [M, N_per_rank]
 
     Returns:
         c (torch.Tensor<float>): local matmul C matrix. shape: [M, N_per_rank]
+            out if provided, else a new tensor. with ctx.cuda_graph, a view of ctx.c_buffer that is overwritten by
+            the next call with the same ctx.
     """
     if ctx is None:
         assert rank is not None and num_ranks is not None
         ctx = create_ag_gemm_intra_node_context(a, b, rank, num_ranks)
+    if ctx.num_ranks == 1:
+        # nothing to gather: a is already the whole A
+        return gemm_persistent(a, b, ctx, out=out) if persistent else gemm_non_persistent(a, b, ctx, out=out)
+    _, _, _, C, _ = _prepare_launch(a, b, ctx, gather=True, out=out)
+    if not ctx.cuda_graph:
+        _ag_gemm_intra_node_impl(a, b, C, ctx, persistent)
+        return C
+
+    # the graph bakes in the addresses of a, b and C
+    graph_key = (a.data_ptr(), b.data_ptr(), C.data_ptr(), a.shape, b.shape, a.dtype, persistent)
+    if ctx.graph is not None and ctx.graph_key == graph_key:
+        ctx.graph.replay()
+        return C
+    if ctx.graph_key != graph_key:
+        # the first call with new inputs runs eagerly, so compilation and autotuning stay outside of the capture
+        ctx.drop_graph()
+        ctx.graph_key = graph_key
+        _ag_gemm_intra_node_impl(a, b, C, ctx, persistent)
+        return C
+    graph = torch.cuda.CUDAGraph()
+    with torch.cuda.graph(graph):
+        _ag_gemm_intra_node_impl(a, b, C, ctx, persistent)
+    ctx.graph = graph
+    graph.replay()
+    return C
+
+
+def _ag_gemm_intra_node_impl(a, b, C, ctx: AllGatherGEMMTensorParallelContext, persistent):
+    """ local copy, allgather and GEMM of `ag_gemm_intra_node`, writing into C.
+        capturable once the kernels are compiled: no host sync, no allocation, the barrier phase lives on the device.
+    """
     M_per_rank, K = a.shape
-    N_per_rank, _ = b.shape
-    C = torch.empty([ctx.num_ranks * M_per_rank, N_per_rank], dtype=a.dtype, device=a.device)
     # The following version doesn't rely on our customized barrier kernel
     # Just reuse nvshmem barrier, they should produce similar performance
 
@@ -866,26 +1671,47 @@ def ag_gemm_intra_node(a, b, ctx: AllGatherGEMMTensorParallelContext = None, ran
     # CUDA_CHECK(err)
     # pynvshmem.nvshmemx_barrier_all_on_stream(current_stream.cuda_stream)
 
+    ag_stream, gemm_stream = ctx.ag_stream, ctx.gemm_stream
+    if ctx.serial:
+        # for debug: the allgather and the GEMM run one after the other on the current stream
+        ag_stream = gemm_stream = torch.cuda.current_stream()
+
     # Use our own customized barrier kernel
-    local_copy_and_barrier_all(ctx.rank, ctx.num_ranks, a, ctx.workspace_tensors[ctx.rank], ctx.comm_buf,
-                               ctx.barrier_tensors[ctx.rank], M_per_rank, K, ctx.phase)
-    ctx.phase += 2
+    if ctx.copy_engine_dispatch:
+        reset_ready_and_barrier_all(ctx.rank, ctx.num_ranks, ctx.comm_buf, ctx.barrier_tensors[ctx.rank],
+                                    ctx.phase_device)
+    elif ctx.fp8:
+        assert persistent, "fp8 allgather is only supported by the persistent GEMM"
+        local_quantize_fp8_and_barrier_all(ctx.rank, ctx.num_ranks, a, ctx.workspace_tensors[ctx.rank],
+                                           ctx.scale_tensors[ctx.rank], ctx.comm_buf, ctx.barrier_tensors[ctx.rank],
+                                           M_per_rank, K, ctx.phase_device, notify_peers=True)
+    else:
+        # the persistent path pulls each peer slot as soon as that peer signals it, no second barrier needed
+        local_copy_and_barrier_all(ctx.rank, ctx.num_ranks, a, ctx.workspace_tensors[ctx.rank], ctx.comm_buf,
+                                   ctx.barrier_tensors[ctx.rank], M_per_rank, K, ctx.phase_device,
+                                   notify_peers=persistent)
     if persistent:
-        ag_gemm_intra_node_persistent_op(a, b, C, ctx.rank, ctx.num_ranks, ctx.workspace_tensors, ctx.barrier_tensors,
-                                         ctx.comm_buf, for_correctness=ctx.for_correctness, ag_stream=ctx.ag_stream,
-                                         gemm_stream=ctx.gemm_stream, serial=ctx.serial, autotune=ctx.autotune)
+        ag_gemm_intra_node_persistent_op(
+            a, b, C, ctx.rank, ctx.num_ranks, ctx.workspace_tensors, ctx.barrier_tensors, ctx.comm_buf,
+            for_correctness=ctx.for_correctness, ag_stream=ag_stream, gemm_stream=gemm_stream, BLOCK_M=ctx.BLOCK_M,
+            BLOCK_N=ctx.BLOCK_N, BLOCK_K=ctx.BLOCK_K, stages=ctx.stages, autotune=ctx.autotune,
+            warp_specialize=ctx.warp_specialize, num_ctas=ctx.num_ctas, fp8=ctx.fp8, scale_tensors=ctx.scale_tensors,
+            num_sms=ctx.num_sms, slot_ready_buf=_slot_ready_buf(ctx.comm_buf, ctx.num_ranks),
+            copy_engine_dispatch=ctx.copy_engine_dispatch, tile_counter=ctx.tile_counter, alloc_fn=ctx.tma_alloc_fn)
     else:
         ag_gemm_non_persistent_op(a, b, C, ctx.rank, ctx.num_local_ranks, ctx.num_ranks, ctx.workspace_tensors,
                                   ctx.barrier_tensors, ctx.comm_buf, for_correctness=ctx.for_correctness,
-                                  ag_stream=ctx.ag_stream, gemm_stream=ctx.gemm_stream, serial=ctx.serial,
-                                  autotune=ctx.autotune, all_gather_method=ctx.all_gather_method)
-    return C
+                                  ag_stream=ag_stream, gemm_stream=gemm_stream, BLOCK_M=ctx.BLOCK_M,
+                                  BLOCK_N=ctx.BLOCK_N, BLOCK_K=ctx.BLOCK_K, stages=ctx.stages, autotune=ctx.autotune,
+                                  all_gather_method=ctx.all_gather_method,
+                                  copy_engine_dispatch=ctx.copy_engine_dispatch)
 
 
 def create_ag_gemm_inter_node_context(tensor_A, tensor_B, rank, num_ranks, num_local_ranks=8, max_M=2**14,
-                                      max_blocks=65536, BLOCK_M=128, BLOCK_N=256, BLOCK_K=64, stages=3,
+                                      max_blocks=65536, BLOCK_M=None, BLOCK_N=None, BLOCK_K=None, stages=None,
                                       for_correctness=False, ag_stream=None, gemm_stream=None, serial=False,
-                                      autotune=False):
+                                      autotune=False, warp_specialize=False, num_ctas=1, nccl_group=None,
+                                      fuse_allgather=False, fp8=False):
     """create context for allgather gemm inter-node
 
     Args:
@@ -895,47 +1721,73 @@ def create_ag_gemm_inter_node_context(tensor_A, tensor_B, rank, num_ranks, num_l
         num_ranks (int): total number of ranks
         max_M: max number of M shape
         max_blocks: max number of blocks on GPU
-        BLOCK_M (int, optional): GEMM tiling factor for M dim. Defaults to 128.
-        BLOCK_N (int, optional): GEMM tiling factor for N dim. Defaults to 256.
-        BLOCK_K (int, optional): GEMM tiling factor for K dim. Defaults to 64.
-        stages (int, optional): GEMM async-copy stages. Defaults to 3.
+        BLOCK_M (int, optional): GEMM tiling factor for M dim. Defaults to None, picked by `pick_config`
+            for the device and the shapes of tensor_A and tensor_B.
+        BLOCK_N (int, optional): GEMM tiling factor for N dim. Defaults to None, picked by `pick_config`.
+        BLOCK_K (int, optional): GEMM tiling factor for K dim. Defaults to None, picked by `pick_config`.
+        stages (int, optional): GEMM async-copy stages. Defaults to None, picked by `pick_config`.
         ag_stream (torch.cuda.streams.Stream, optional): The stream used for allgather, if not provided, create a new one. Defaults to None.
         gemm_stream (torch.cuda.streams.Stream, optional): The stream used for gemm, if not provided, use current stream. Defaults to None.
         serial (bool, optional): Make the execution serialized, for debug. Defaults to False.
         autotune (bool, optional): whether to enable autotune. Defaults to False.
+        warp_specialize (bool, optional): whether to warp-specialize the persistent GEMM main loop. Blackwell only. Defaults to False.
+        num_ctas (int, optional): CTAs per thread block cluster of the persistent GEMM, sm90+ only. Defaults to 1.
+        nccl_group (torch.distributed.ProcessGroup, optional): NCCL group of all ranks, used for large allgathers.
+            Defaults to None.
+        fuse_allgather (bool, optional): whether the persistent path runs the allgather and the GEMM as a single
+            kernel launch. Not supported with autotune, warp_specialize, num_ctas > 1 or nccl_group. Defaults to False.
+        fp8 (bool, optional): whether to allgather A as fp8 e4m3 with per-row scales, halving the allgather bytes
+            across nodes. The persistent GEMM applies the scales in its epilogue. Not supported with fuse_allgather
+            or nccl_group. Defaults to False.
 
     Returns:
         AllGatherGEMMTensorParallelContext
     """
-    _, K = tensor_A.shape
+    M_per_rank, K = tensor_A.shape
     assert tensor_B.shape[
         1] == K, f"tensor_B should has shape (col_major) [N_per_rank, {K}], but get [{tensor_B.shape}]"
     assert tensor_A.dtype == tensor_B.dtype
-    dtype = tensor_A.dtype
+    assert not (fp8 and (fuse_allgather or nccl_group is not None)), "fp8 only supports the unfused nvshmem allgather"
+    dtype = torch.float8_e4m3fn if fp8 else tensor_A.dtype
+    num_sms = _sm_count(torch.cuda.current_device())
+    BLOCK_M, BLOCK_N, BLOCK_K, stages = _resolve_tiling(BLOCK_M, BLOCK_N, BLOCK_K, stages, M_per_rank * num_ranks,
+                                                        tensor_B.shape[0], K, dtype.itemsize, num_sms,
+                                                        tensor_B.element_size())
 
     local_rank = rank % num_local_ranks
 
-    fake_barrier = torch.ones([num_ranks], dtype=torch.int32, device=tensor_A.device)
+    fake_barrier = _get_fake_barrier(num_ranks, torch.cuda.current_device())
     workspaces = pynvshmem.nvshmem_create_tensor_list_intra_node([max_M, K], dtype)
-    barriers = pynvshmem.nvshmem_create_tensor_list_intra_node([num_ranks], torch.uint64)
+    scales = pynvshmem.nvshmem_create_tensor_list_intra_node([max_M], torch.float32) if fp8 else None
+    # flags padded to whole 16B chunks, which `multi_flag_wait` reads
+    barriers = pynvshmem.nvshmem_create_tensor_list_intra_node([triton.cdiv(num_ranks, 2) * 2], torch.uint64)
+    barriers = [barrier[:num_ranks] for barrier in barriers]
     comm_buf = pynvshmem.nvshmem_create_tensor([3 * num_ranks], torch.int32)
-    comm_buf.fill_(0)
-    barriers[local_rank].fill_(0)
+    phase_device = torch.empty([1], dtype=torch.int32, device=tensor_A.device)
+    init_context_buffers_kernel[(1, )](comm_buf, barriers[local_rank], phase_device, num_ranks,
+                                       BLOCK_SIZE=triton.next_power_of_2(3 * num_ranks))
+    tile_counter = _create_tile_counter(tensor_A.device)
     current_stream = torch.cuda.current_stream()
     pynvshmem.nvshmemx_barrier_all_on_stream(current_stream.cuda_stream)
-    torch.cuda.synchronize()
+    # no device sync: work on this stream is ordered after the init, other streams wait on ready_event once
+    ready_event = torch.cuda.Event()
+    ready_event.record(current_stream)
 
     ret = AllGatherGEMMTensorParallelContext(
         rank=rank, num_ranks=num_ranks, local_rank=local_rank, num_local_ranks=num_local_ranks,
         workspace_tensors=workspaces, barrier_tensors=barriers, fake_barrier_tensor=fake_barrier, comm_buf=comm_buf,
-        for_correctness=for_correctness, ag_stream=ag_stream, internode_ag_stream=torch.cuda.Stream(),
-        gemm_stream=gemm_stream, serial=serial, BLOCK_M=BLOCK_M, BLOCK_N=BLOCK_N, BLOCK_K=BLOCK_K, stages=stages,
-        autotune=autotune, all_gather_method=get_auto_all_gather_method(num_local_ranks, num_ranks))
+        for_correctness=for_correctness, ag_stream=ag_stream if ag_stream is not None else torch.cuda.Stream(),
+        internode_ag_stream=torch.cuda.Stream(), gemm_stream=gemm_stream, serial=serial, BLOCK_M=BLOCK_M,
+        BLOCK_N=BLOCK_N, BLOCK_K=BLOCK_K, stages=stages, autotune=autotune,
+        all_gather_method=get_auto_all_gather_method(num_local_ranks, num_ranks), warp_specialize=warp_specialize,
+        num_ctas=num_ctas, nccl_group=nccl_group, num_sms=num_sms, phase_device=phase_device, ready_event=ready_event,
+        fuse_allgather=fuse_allgather, fp8=fp8, scale_tensors=scales, tile_counter=tile_counter)
 
     return ret
 
 
-def ag_gemm_inter_node(a, b, ctx=None, rank=None, num_ranks=None, local_world_size=8, signal_target=1, persistent=True):
+def ag_gemm_inter_node(a, b, ctx=None, rank=None, num_ranks=None, local_world_size=8, signal_target=1, persistent=True,
+                       out=None):
     """allgather gemm for inter-node
     Allgather global matrix A and do matmul with local matrix B, produces local matrix C
 
@@ -943,56 +1795,96 @@ def ag_gemm_inter_node(a, b, ctx=None, rank=None, num_ranks=None, local_world_si
         a (torch.Tensor<float>): local matmul A matrix. shape: [M_per_rank, K]
         b (torch.Tensor<float>): local matmul B matrix. shape: [N_per_rank, K]
         ctx: (Optional[AllGatherGEMMTensorParallelContext]): if not provided, created immediately
+        out (Optional[torch.Tensor<float>]): written with C if provided. shape: [M, N_per_rank]
 
     Returns:
         c (torch.Tensor<float>): local matmul C matrix. shape: [M, N_per_rank]
+            out if provided, else a new tensor. with ctx.cuda_graph, a view of ctx.c_buffer that is overwritten by
+            the next call with the same ctx.
     """
     if ctx is None:
         assert rank is not None and num_ranks is not None
         ctx = create_ag_gemm_inter_node_context(a, b, rank, num_ranks)
-    M_per_rank, K = a.shape
-    N_per_rank, _ = b.shape
-    C = torch.empty([ctx.num_ranks * M_per_rank, N_per_rank], dtype=a.dtype, device=a.device)
-
-    local_copy_and_barrier_all(ctx.rank, ctx.num_ranks, a, ctx.workspace_tensors[ctx.local_rank], ctx.comm_buf,
-                               ctx.barrier_tensors[ctx.local_rank], M_per_rank, K, ctx.phase, is_internode=True)
-    ctx.phase += 2
+    if ctx.num_ranks == 1:
+        # nothing to gather: a is already the whole A
+        return gemm_persistent(a, b, ctx, out=out) if persistent else gemm_non_persistent(a, b, ctx, out=out)
+    if ctx.num_ranks == ctx.num_local_ranks:
+        # a single node: the buffers of the inter-node context fit the intra-node path, which needs no nvshmem put.
+        # that path pulls A over NVLink, so ctx.fuse_allgather and ctx.nccl_group do not apply there.
+        return ag_gemm_intra_node(a, b, ctx=ctx, persistent=persistent, out=out)
+    M, _, K, C, _ = _prepare_launch(a, b, ctx, gather=True, out=out)
+    M_per_rank = a.shape[0]
+
+    ag_stream, internode_ag_stream, gemm_stream = ctx.ag_stream, ctx.internode_ag_stream, ctx.gemm_stream
+    if ctx.serial:
+        # for debug: the allgather and the GEMM run one after the other on the current stream
+        ag_stream = internode_ag_stream = gemm_stream = torch.cuda.current_stream()
+
+    if ctx.fp8:
+        assert persistent, "fp8 allgather is only supported by the persistent GEMM"
+        local_quantize_fp8_and_barrier_all(ctx.rank, ctx.num_ranks, a, ctx.workspace_tensors[ctx.local_rank],
+                                           ctx.scale_tensors[ctx.local_rank], ctx.comm_buf,
+                                           ctx.barrier_tensors[ctx.local_rank], M_per_rank, K, ctx.phase_device,
+                                           is_internode=True)
+    else:
+        local_copy_and_barrier_all(ctx.rank, ctx.num_ranks, a, ctx.workspace_tensors[ctx.local_rank], ctx.comm_buf,
+                                   ctx.barrier_tensors[ctx.local_rank], M_per_rank, K, ctx.phase_device,
+                                   is_internode=True)
 
+    # the tiling is resolved once by the context. passing only part of it would re-pick the rest per call, e.g. a
+    # wider BLOCK_N at a larger M next to the stages picked for the narrower one, overflowing shared memory.
     if persistent:
-        # TODO(houqi.1993) many arguments use default such as BLOCK_M/N/K and stages. not passed
-        ag_gemm_inter_node_persistent_op(a, b, C, ctx.rank, ctx.num_ranks, ctx.workspace_tensors, ctx.barrier_tensors,
-                                         ctx.comm_buf, ag_stream=ctx.ag_stream, stages=ctx.stages,
-                                         internode_ag_stream=ctx.internode_ag_stream, gemm_stream=ctx.gemm_stream,
-                                         autotune=ctx.autotune, local_world_size=local_world_size,
-                                         signal_target=signal_target, copy_engine_dispatch=True)
+        ag_gemm_inter_node_persistent_op(
+            a, b, C, ctx.rank, ctx.num_ranks, ctx.workspace_tensors, ctx.barrier_tensors, ctx.comm_buf,
+            ag_stream=ag_stream, BLOCK_M=ctx.BLOCK_M, BLOCK_N=ctx.BLOCK_N, BLOCK_K=ctx.BLOCK_K, stages=ctx.stages,
+            internode_ag_stream=internode_ag_stream, gemm_stream=gemm_stream, autotune=ctx.autotune,
+            local_world_size=local_world_size, signal_target=signal_target, copy_engine_dispatch=not ctx.fuse_allgather,
+            warp_specialize=ctx.warp_specialize, num_ctas=ctx.num_ctas, nccl_group=ctx.nccl_group, num_sms=ctx.num_sms,
+            kernel_cache=ctx.kernel_cache, fuse_allgather=ctx.fuse_allgather, fp8=ctx.fp8,
+            scale_tensors=ctx.scale_tensors, tile_counter=ctx.tile_counter, alloc_fn=ctx.tma_alloc_fn)
     else:
-        # TODO(houqi.1993) many arguments use default such as BLOCK_M/N/K and stages. not passed
         ag_gemm_non_persistent_op(a, b, C, ctx.rank, ctx.num_local_ranks, ctx.num_ranks, ctx.workspace_tensors,
                                   ctx.barrier_tensors, ctx.comm_buf, for_correctness=ctx.for_correctness,
-                                  ag_stream=ctx.ag_stream, gemm_stream=ctx.gemm_stream, serial=ctx.serial,
-                                  autotune=ctx.autotune, all_gather_method=ctx.all_gather_method)
+                                  ag_stream=ag_stream, gemm_stream=gemm_stream, BLOCK_M=ctx.BLOCK_M,
+                                  BLOCK_N=ctx.BLOCK_N, BLOCK_K=ctx.BLOCK_K, stages=ctx.stages, autotune=ctx.autotune,
+                                  all_gather_method=ctx.all_gather_method, nccl_group=ctx.nccl_group)
 
     return C
 
 
-def gemm_persistent(a, b, ctx: AllGatherGEMMTensorParallelContext):
-    M, K = a.shape
-    N, _ = b.shape
-    C = torch.empty([M, N], dtype=a.dtype, device=a.device)
+def _gemm_tiling(ctx: AllGatherGEMMTensorParallelContext, a, M, N, K, num_sms):
+    """ tiling of the `gemm_*` GEMMs, which read a as given. the context tiling is sized for the staged payload,
+        fp8 with ctx.fp8 while a stays 16-bit, so it is picked again from a's element size then.
+    """
+    if not ctx.fp8:
+        return ctx.BLOCK_M, ctx.BLOCK_N, ctx.BLOCK_K, ctx.stages
+    return _resolve_tiling(None, None, None, None, M, N, K, a.element_size(), num_sms)
 
-    NUM_SMS = torch.cuda.get_device_properties("cuda").multi_processor_count
 
-    def alloc_fn(size: int, alignment: int, stream: Optional[int]):
-        return torch.empty(size, device="cuda", dtype=torch.int8)
+def gemm_persistent(a, b, ctx: AllGatherGEMMTensorParallelContext, out=None):
+    M, N, K, C, NUM_SMS = _prepare_launch(a, b, ctx, out=out)
 
-    triton.set_allocator(alloc_fn)
+    device_index = torch.cuda.current_device()
+    if not ctx.autotune:
+        # each persistent program is a cluster of num_ctas CTAs
+        NUM_SMS = NUM_SMS // ctx.num_ctas
+        BLOCK_M, BLOCK_N, BLOCK_K, stages = _gemm_tiling(ctx, a, M, N, K, NUM_SMS)
+    dynamic_tile_schedule = _use_dynamic_tile_schedule(device_index)
+    tile_counter = _resolve_tile_counter(ctx.tile_counter, dynamic_tile_schedule, device_index,
+                                         torch.cuda.current_stream())
+    swizzle_lut = _get_swizzle_rank_lut(ctx.rank, ctx.num_ranks, ctx.num_local_ranks, device_index)
+
+    triton.set_allocator(ctx.tma_alloc_fn)
 
-    grid = lambda META: (min(
-        NUM_SMS,
-        triton.cdiv(M, META["BLOCK_SIZE_M"]) * triton.cdiv(N, META["BLOCK_SIZE_N"]),
-    ), )
     if not ctx.autotune:
-        kernel_consumer_gemm_persistent[grid](
+        gemm_grid = (min(NUM_SMS, triton.cdiv(M, BLOCK_M) * triton.cdiv(N, BLOCK_N)), 1, 1)
+        key = ("gemm", M, N, K, a.dtype, ctx.rank, ctx.num_ranks, BLOCK_M, BLOCK_N,
+               BLOCK_K, ctx.num_local_ranks, stages, ctx.num_ctas, ctx.warp_specialize, dynamic_tile_schedule,
+               a.data_ptr() % 16 == 0, b.data_ptr() % 16 == 0)
+        _launch_gemm_persistent_cached(
+            ctx.kernel_cache,
+            key,
+            gemm_grid,
             a,
             b,
             C,  #
@@ -1003,34 +1895,47 @@ def gemm_persistent(a, b, ctx: AllGatherGEMMTensorParallelContext):
             ctx.num_ranks,
             ctx.fake_barrier_tensor,
             ctx.comm_buf,
-            ctx.BLOCK_M,
-            ctx.BLOCK_N,
-            ctx.BLOCK_K,
+            BLOCK_M,
+            BLOCK_N,
+            BLOCK_K,
             8,
-            False,
+            True,  # EPILOGUE_SUBTILE
             NUM_SMS=NUM_SMS,
-            num_stages=ctx.stages,
+            LOCAL_WORLD_SIZE=ctx.num_local_ranks,
+            tile_counter_ptr=tile_counter,
+            DYNAMIC_TILE_SCHEDULE=dynamic_tile_schedule,
+            WARP_SPECIALIZE=ctx.warp_specialize,
+            swizzle_lut_ptr=swizzle_lut,
+            num_stages=stages,
             num_warps=8,
+            num_ctas=ctx.num_ctas,
         )
     else:
+        grid = lambda META: (min(
+            NUM_SMS,
+            triton.cdiv(M, META["BLOCK_SIZE_M"]) * triton.cdiv(N, META["BLOCK_SIZE_N"]),
+        ), )
         kernel_consumer_gemm_persistent_autotune[grid](
             a, b, C,  #
             M, N, K,  #
-            ctx.rank, ctx.num_ranks, ctx.fake_barrier_tensor, ctx.comm_buf, EPILOGUE_SUBTILE=False, NUM_SMS=NUM_SMS  #
+            ctx.rank, ctx.num_ranks, ctx.fake_barrier_tensor, ctx.comm_buf, EPILOGUE_SUBTILE=True, NUM_SMS=NUM_SMS,
+            LOCAL_WORLD_SIZE=ctx.num_local_ranks, tile_counter_ptr=tile_counter,
+            DYNAMIC_TILE_SCHEDULE=dynamic_tile_schedule, WARP_SPECIALIZE=ctx.warp_specialize,
+            swizzle_lut_ptr=swizzle_lut  #
         )
 
-    pynvshmem.nvshmemx_barrier_all_on_stream(torch.cuda.current_stream().cuda_stream)
+    if ctx.num_ranks > 1:
+        pynvshmem.nvshmemx_barrier_all_on_stream(torch.cuda.current_stream().cuda_stream)
 
     return C
 
 
-def gemm_non_persistent(a, b, ctx: AllGatherGEMMTensorParallelContext):
-    M, K = a.shape
-    N, _ = b.shape
-    C = torch.empty([M, N], dtype=a.dtype, device=a.device)
+def gemm_non_persistent(a, b, ctx: AllGatherGEMMTensorParallelContext, out=None):
+    M, N, K, C, NUM_SMS = _prepare_launch(a, b, ctx, out=out)
 
-    grid = lambda META: (triton.cdiv(M, META["BLOCK_SIZE_M"]) * triton.cdiv(N, META["BLOCK_SIZE_N"]), )
     if not ctx.autotune:
+        BLOCK_M, BLOCK_N, BLOCK_K, stages = _gemm_tiling(ctx, a, M, N, K, NUM_SMS)
+        grid = (triton.cdiv(M, BLOCK_M) * triton.cdiv(N, BLOCK_N), )
         kernel_consumer_gemm_non_persistent[grid](
             a,
             b,
@@ -1047,18 +1952,22 @@ def gemm_non_persistent(a, b, ctx: AllGatherGEMMTensorParallelContext):
             ctx.rank,
             ctx.num_ranks,
             ctx.fake_barrier_tensor,
-            ctx.BLOCK_M,
-            ctx.BLOCK_N,
-            ctx.BLOCK_K,
+            BLOCK_M,
+            BLOCK_N,
+            BLOCK_K,
             8,
-            num_stages=ctx.stages,
+            num_stages=stages,
             num_warps=8,
         )
     else:
+        grid = lambda META: (triton.cdiv(M, META["BLOCK_SIZE_M"]) * triton.cdiv(N, META["BLOCK_SIZE_N"]), )
         kernel_consumer_gemm_persistent_autotune[grid](
             a, b, C,  #
             M, N, K,  #
-            ctx.rank, ctx.num_ranks, ctx.fake_barrier_tensor, ctx.comm_buf, EPILOGUE_SUBTILE=False, NUM_SMS=0  #
+            ctx.rank, ctx.num_ranks, ctx.fake_barrier_tensor, ctx.comm_buf, EPILOGUE_SUBTILE=False, NUM_SMS=0,
+            LOCAL_WORLD_SIZE=ctx.num_local_ranks,
+            swizzle_lut_ptr=_get_swizzle_rank_lut(ctx.rank, ctx.num_ranks, ctx.num_local_ranks,
+                                                  torch.cuda.current_device())  #
         )
 
     return C
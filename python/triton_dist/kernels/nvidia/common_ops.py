@@ -85,6 +85,73 @@ def barrier_on_this_grid(ptr):
     __syncthreads()
 
 
+@tl.core.extern
+def _ld_acquire_gpu_v4_b32(ptr, _builder=None):
+    return tl.inline_asm_elementwise(
+        asm="""
+        ld.acquire.gpu.global.v4.b32 {$0,$1,$2,$3}, [$4];
+        """,
+        constraints=("=r,=r,=r,=r,l"),
+        args=[ptr],
+        dtype=(tl.int32, tl.int32, tl.int32, tl.int32),
+        is_pure=False,
+        pack=1,
+        _builder=_builder,
+    )
+
+
+@tl.core.extern
+def _ld_acquire_gpu_v2_b64(ptr, _builder=None):
+    return tl.inline_asm_elementwise(
+        asm="""
+        ld.acquire.gpu.global.v2.b64 {$0,$1}, [$2];
+        """,
+        constraints=("=l,=l,l"),
+        args=[ptr],
+        dtype=(tl.int64, tl.int64),
+        is_pure=False,
+        pack=1,
+        _builder=_builder,
+    )
+
+
+@triton.jit
+def _flag_pending(flag, idx, flag_beg, flag_end, value):
+    return (flag != value) & (idx >= flag_beg) & (idx <= flag_end)
+
+
+@triton.jit
+def multi_flag_wait(ptr, flag_beg, flag_end, value):
+    """ wait until ptr[flag_beg], ..., ptr[flag_end] all equal value. returns a token for dl.consume_token.
+
+        flags are polled with 128-bit acquire loads of whole 16B chunks, 4 int32 or 2 int64 flags at a time, so ptr
+        should be 16B aligned and the flag array padded to a multiple of 16B: a range that ends inside a chunk also
+        reads the flags after flag_end up to the chunk end, e.g. one past the array for an odd number of int64 flags.
+        flags outside the range are read but not waited for. an empty range (flag_end < flag_beg) issues no load.
+    """
+    token = tl.full([], 0, tl.int32)
+    if flag_end < flag_beg:
+        pass
+    elif ptr.dtype.element_ty.primitive_bitwidth == 64:
+        for chunk in range(flag_beg // 2 * 2, flag_end + 1, 2):
+            v0, v1 = _ld_acquire_gpu_v2_b64(ptr + chunk)
+            while (_flag_pending(v0, chunk, flag_beg, flag_end, value)
+                   | _flag_pending(v1, chunk + 1, flag_beg, flag_end, value)):
+                v0, v1 = _ld_acquire_gpu_v2_b64(ptr + chunk)
+            token = v0.to(tl.int32)
+    else:
+        tl.static_assert(ptr.dtype.element_ty.primitive_bitwidth == 32)
+        for chunk in range(flag_beg // 4 * 4, flag_end + 1, 4):
+            v0, v1, v2, v3 = _ld_acquire_gpu_v4_b32(ptr + chunk)
+            while (_flag_pending(v0, chunk, flag_beg, flag_end, value)
+                   | _flag_pending(v1, chunk + 1, flag_beg, flag_end, value)
+                   | _flag_pending(v2, chunk + 2, flag_beg, flag_end, value)
+                   | _flag_pending(v3, chunk + 3, flag_beg, flag_end, value)):
+                v0, v1, v2, v3 = _ld_acquire_gpu_v4_b32(ptr + chunk)
+            token = v0
+    return token
+
+
 @triton.jit(do_not_specialize=["rank", "num_ranks"])
 def barrier_all_intra_node_atomic_cas_block(rank, num_ranks, symm_flag_ptr):
     """ NOTE: this function should only be called with atomic support. memory over PCI-e does not support atomic r/w. DON'T use this function on such platforms.
@@ -159,6 +226,35 @@ def barrier_all_intra_node_non_atomic(rank, num_ranks, symm_flags, target_value)
     barrier_on_this_grid(symm_flags + 2 * num_ranks)
 
 
+@triton.jit(do_not_specialize=["rank", "num_ranks", "target_value"])
+def tree_barrier_intra_node(rank, num_ranks, symm_flags, target_value):
+    """ dissemination barrier: in round k each rank signals rank + 2^k and waits for rank - 2^k, so all ranks are
+        synced after ceil(log2(num_ranks)) rounds instead of each rank exchanging flags with every other rank.
+        should be called by a single CTA.
+
+        symm_flags is expected to:
+        1. of int32 dtype
+        2. has at least ceil(log2(num_ranks)) elements
+        3. of symmetric pointer
+
+        flags are never reset, so target_value should increase from call to call.
+    """
+    tl.static_assert(symm_flags.dtype.element_ty == tl.int32)
+    __syncthreads()
+    if tid(axis=0) == 0:
+        dist = 1
+        round_idx = 0
+        while dist < num_ranks:
+            remote_ptr = dl.symm_at(symm_flags + round_idx, (rank + dist) % num_ranks)
+            st(remote_ptr, target_value, scope="sys", semantic="release")
+            # a peer may already be in the next barrier, so wait for at least target_value
+            while ld(symm_flags + round_idx, scope="sys", semantic="acquire") < target_value:
+                pass
+            dist *= 2
+            round_idx += 1
+    __syncthreads()
+
+
 def barrier_all_on_stream(stream, is_intra_node=False, symm_barrier_buf=None, local_world_size=0, barrier_value=1,  #
                           ):
     # TODO(houqi.1993) make a sync context and do the barrier_value inc inner the funtion
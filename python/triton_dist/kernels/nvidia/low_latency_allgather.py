@@ -607,14 +607,15 @@ def _recv_ll_and_multimem_st_ll_block(dest_ptr, src_ptr, num_ints, ll_flag):
 
 
 @triton.jit
-def broadcast_naive_block(dst_ptr, src_ptr, nbytes):
+def broadcast_naive_block(dst_ptr, src_ptr, nbytes, block_id=0, num_blocks=1):
+    """ multimem.st src to dst of all ranks in the node. block_id out of num_blocks blocks share the copy. """
     thread_idx = tid(axis=0)
     block_dim = ntid(axis=0)
     src_ptr = tl.cast(src_ptr, tl.pointer_type(tl.int8))
     dst_ptr = tl.cast(dst_ptr, tl.pointer_type(tl.int8))
     dst_mc_ptr = libshmem_device.remote_mc_ptr(libshmem_device.NVSHMEMX_TEAM_NODE, dst_ptr)
     num_int4 = nbytes // 16
-    for n in range(thread_idx, num_int4, block_dim):
+    for n in range(thread_idx + block_dim * block_id, num_int4, block_dim * num_blocks):
         val0, val1 = load_v2_b64(src_ptr + 16 * n)
         multimem_st_b64(dst_mc_ptr + n * 16, val0)
         multimem_st_b64(dst_mc_ptr + n * 16 + 8, val1)
@@ -57,6 +57,12 @@ def parse_args():
     parser.add_argument("--autotune", default=False, action="store_true")
     parser.add_argument("--debug", default=False, action="store_true")
     parser.add_argument("--profile", default=False, action="store_true")
+    parser.add_argument("--nccl", default=False, action="store_true", help="use NCCL for large allgathers")
+    parser.add_argument("--fuse_allgather", default=False, action="store_true",
+                        help="run the allgather and the persistent GEMM as one kernel")
+    parser.add_argument("--fp8", default=False, action="store_true", help="allgather A as fp8, perf_test only")
+    parser.add_argument("--single_node", default=False, action="store_true",
+                        help="check the single-node paths, launch with --nproc_per_node=1 for the 1-rank one")
     parser.add_argument(
         "--persistent",
         action=argparse.BooleanOptionalAction,
@@ -178,10 +184,9 @@ def perf_test_ag_only(name, M, config):
             ctx.barrier_tensors[ctx.local_rank],
             M_per_rank,
             K,
-            phase=ctx.phase,
+            phase_ptr=ctx.phase_device,
             is_internode=True,
         )
-        ctx.phase += 2
         inter_node_allgather(
             A,
             ctx.workspace_tensors,
@@ -234,6 +239,27 @@ def torch_ag_gemm(
     return ag_gemm_output
 
 
+def test_single_node(name, M, config, persistent: bool = True):
+    """ ag_gemm_inter_node on one node: the gemm shortcut with one rank, the intra-node path with more """
+    assert NNODES == 1, "launch on a single node"
+    N = config["N"]
+    K = config["K"]
+    M_per_rank = M // WORLD_SIZE
+    N_per_rank = N // WORLD_SIZE
+
+    A = torch.randn([M_per_rank, K], dtype=dtype, device="cuda")
+    B = torch.randn([N_per_rank, K], dtype=dtype, device="cuda")
+    torch_ag_buffer = torch.empty([M, K], dtype=dtype, device="cuda")
+
+    ctx = create_ag_gemm_inter_node_context(A, B, RANK, WORLD_SIZE, num_local_ranks=LOCAL_WORLD_SIZE, max_M=M,
+                                            ag_stream=torch.cuda.Stream(), gemm_stream=torch.cuda.Stream())
+    for use_persistent in ([True, False] if persistent else [False]):
+        C = ag_gemm_inter_node(A, B, ctx=ctx, local_world_size=LOCAL_WORLD_SIZE, persistent=use_persistent)
+        C_golden = torch_ag_gemm(TP_GROUP, A, B.T, torch_ag_buffer)
+        assert_allclose(C_golden, C, atol=1e-3, rtol=1e-3)
+    dist_print(f"{name} single node ({WORLD_SIZE} ranks) passed", need_sync=True, allowed_ranks=[0])
+
+
 def perf_test(name, M, config, persistent: bool = True):
     N = config["N"]
     K = config["K"]
@@ -249,19 +275,24 @@ def perf_test(name, M, config, persistent: bool = True):
 
     torch_ag_buffer = torch.empty([M, K], dtype=dtype, device="cuda")
 
+    tiling = dict(BLOCK_M=config["BM"], BLOCK_N=config["BN"], BLOCK_K=config["BK"], stages=config["stage"])
+    if args.fp8:
+        # the tabulated BK=64 is narrower than a 128B swizzle row of fp8 A, let `pick_config` choose the tiling
+        tiling = dict(BLOCK_M=None, BLOCK_N=None, BLOCK_K=None, stages=None)
+
     ctx = create_ag_gemm_inter_node_context(
         A,
         B,
         RANK,
         WORLD_SIZE,
         max_M=M,
-        BLOCK_M=config["BM"],
-        BLOCK_N=config["BN"],
-        BLOCK_K=config["BK"],
-        stages=config["stage"],
+        **tiling,
         ag_stream=torch.cuda.Stream(),
         gemm_stream=torch.cuda.Stream(),
         autotune=args.autotune,
+        nccl_group=TP_GROUP if args.nccl else None,
+        fuse_allgather=args.fuse_allgather,
+        fp8=args.fp8,
     )
 
     def triton_func():
@@ -292,7 +323,12 @@ def perf_test(name, M, config, persistent: bool = True):
     for i in range(WORLD_SIZE):
         torch.distributed.barrier(TP_GROUP)
         if RANK == i:
-            assert_allclose(C_golden, C, atol=1e-3, rtol=1e-3)
+            if args.fp8:
+                # A went through fp8 e4m3, check the relative error instead
+                rel_err = (C.float() - C_golden.float()).norm() / C_golden.float().norm()
+                assert rel_err < 0.1, rel_err
+            else:
+                assert_allclose(C_golden, C, atol=1e-3, rtol=1e-3)
 
     with group_profile(
             f"trace_ag_gemm_inter_node/m_{M}_n_{N}_k_{K}",
@@ -355,7 +391,10 @@ if __name__ == "__main__":
         },
     }
 
-    if args.gemm_only:
+    if args.single_node:
+        for testcase, value in configs.items():
+            test_single_node(testcase, args.M, value, args.persistent)
+    elif args.gemm_only:
         for testcase, value in configs.items():
             perf_test_gemm_only(testcase, args.M, value, args.persistent)
     elif args.ag_only:
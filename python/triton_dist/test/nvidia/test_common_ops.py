@@ -28,11 +28,14 @@ import random
 
 import torch
 import torch.distributed
+import triton
+import triton.language as tl
 
 from triton_dist import pynvshmem
 from triton_dist.kernels.nvidia.common_ops import (barrier_all_intra_node_non_atomic,
                                                    barrier_all_intra_node_non_atomic_block, barrier_on_this_grid,
-                                                   barrier_all_intra_node_atomic_cas_block)
+                                                   barrier_all_intra_node_atomic_cas_block, tree_barrier_intra_node,
+                                                   multi_flag_wait)
 from triton_dist.utils import check_p2p_native_atomic_supported
 
 WORLD_SIZE = int(os.environ.get("WORLD_SIZE", 1))
@@ -95,6 +98,60 @@ def test_barrier_all_intra_node():
     print("✅ barrier_all_intra_node_atomic_cas_block passed")
 
 
+def test_tree_barrier_intra_node():
+    print(">> tree_barrier_intra_node start...")
+    num_rounds = max(1, (LOCAL_WORLD_SIZE - 1).bit_length())
+    symm_flags = pynvshmem.nvshmem_create_tensor_list_intra_node((num_rounds, ), torch.int32)
+    symm_iters = pynvshmem.nvshmem_create_tensor_list_intra_node((1, ), torch.int32)
+    symm_flags[LOCAL_RANK].fill_(0)
+    symm_iters[LOCAL_RANK].fill_(0)
+    pynvshmem.nvshmem_barrier_all()
+
+    num_iters = 1000
+    # past the barrier of iteration n every rank has entered it, so no peer can be behind n + 1
+    lag = torch.empty((num_iters, ), dtype=torch.int32, device="cuda")
+    for n in range(num_iters):
+        _random_sleep()
+        symm_iters[LOCAL_RANK].fill_(n + 1)
+        tree_barrier_intra_node[(1, )](LOCAL_RANK, LOCAL_WORLD_SIZE, symm_flags[LOCAL_RANK], n + 1)
+        lag[n] = n + 1 - torch.cat(symm_iters).min()
+    assert (lag <= 0).all(), f"a peer was behind by {lag.max().item()} iterations"
+
+    print("✅ tree_barrier_intra_node passed")
+
+
+@triton.jit
+def _multi_flag_wait_kernel(flags_ptr, flag_beg, flag_end, value, out_ptr):
+    multi_flag_wait(flags_ptr, flag_beg, flag_end, value)
+    if flag_end >= flag_beg:
+        tl.store(out_ptr, tl.load(flags_ptr + flag_end, volatile=True).to(tl.int32))
+
+
+def test_multi_flag_wait():
+    print(">> multi_flag_wait start...")
+    num_flags = 16
+    value = 7
+    wait_stream, set_stream = torch.cuda.Stream(), torch.cuda.Stream()
+    for dtype in (torch.int32, torch.int64):
+        # ranges starting and ending on and off the 2 and 4 flag chunk boundaries, and empty ones
+        for flag_beg in range(0, 9):
+            for flag_end in range(flag_beg - 1, 12):
+                flags = torch.full((num_flags, ), value - 1, dtype=dtype, device="cuda")
+                out = torch.zeros((1, ), dtype=torch.int32, device="cuda")
+                torch.cuda.synchronize()
+                with torch.cuda.stream(wait_stream):
+                    _multi_flag_wait_kernel[(1, )](flags, flag_beg, flag_end, value, out)
+                with torch.cuda.stream(set_stream):
+                    # flags outside the range stay at value - 1, the wait hangs if it checks them
+                    torch.cuda._sleep(int(random.random() * 100000))
+                    flags[flag_beg:flag_end + 1].fill_(value)
+                torch.cuda.synchronize()
+                if flag_end >= flag_beg:
+                    assert out.item() == value, f"{dtype} [{flag_beg}, {flag_end}]: got {out.item()}"
+
+    print("✅ multi_flag_wait passed")
+
+
 if __name__ == "__main__":
     torch.cuda.set_device(LOCAL_RANK)
     torch.distributed.init_process_group(
@@ -112,3 +169,5 @@ if __name__ == "__main__":
     test_barrier_on_this_grid()
     test_barrier_all_intra_node_non_atomic()
     test_barrier_all_intra_node()
+    test_tree_barrier_intra_node()
+    test_multi_flag_wait()